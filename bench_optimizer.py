@@ -0,0 +1,191 @@
+""" Benchmark the allocation solvers on synthetic cubes.
+
+Generates seeded indiv/comb frames over a grid of currency counts, exchange
+counts, dust ratios and (in)feasibility, runs every backend on each and
+writes one JSON object per run (wall time, iterations, L1 distance,
+constraint residuals, success) so runs can be compared.
+
+    python bench_optimizer.py [--currencies 5 20] [--exchanges 1 3] [--output bench.jsonl]
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+from itertools import product
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+import optimizer
+from optimizer import (find_solutions, verify_solution, perform_regr,
+                       perform_regr_L2, calculate_transfers, layout_incidence)
+
+SEED = 0
+RUNS = 3  # Problems per grid point
+CURRENCIES = [5, 20, 50]
+EXCHANGES = [1, 3, 6]
+DUST = [0, 0.3]  # Fraction of balances that are dust
+HOLDING = 0.7  # Chance a currency is held on an exchange
+TIMEOUT = 120  # Seconds before a single run is abandoned
+VAL_CUR = 1
+
+
+class Timeout(Exception):
+    pass
+
+
+def make_problem(rng, n_cur, n_ex, dust=0., infeasible=False):
+    """ Random indiv/comb frames shaped like calc_indiv/calc_comb output.
+
+    If infeasible, one currency is only held on the smallest exchange and
+    targeted above that exchange's funds, so only the L2 problem is solvable.
+    """
+    cur_ids = np.arange(1, n_cur + 1)
+    ex_ids = np.arange(1, n_ex + 1)
+    held = rng.random((n_cur, n_ex)) < HOLDING
+    # Valuation currency everywhere, every currency somewhere
+    held[0] = True
+    held[np.arange(n_cur), rng.integers(0, n_ex, n_cur)] = True
+    cur, ex = np.nonzero(held)
+    indiv = pd.DataFrame({'cur_id': cur_ids[cur], 'ex_id': ex_ids[ex]})
+    indiv['price'] = np.exp(rng.normal(0, 3, n_cur))[cur]
+    indiv['val'] = rng.lognormal(0, 1.5, len(indiv))
+    indiv.loc[rng.random(len(indiv)) < dust, 'val'] = 1e-9
+    indiv['bal'] = indiv.val / indiv.price
+    indiv['bal_tgt'] = np.nan
+
+    pct = rng.dirichlet(np.ones(n_cur))
+    if infeasible and n_ex > 1 and n_cur > 1:
+        small = indiv.groupby('ex_id').val.sum().idxmin()
+        only = cur_ids[-1]
+        indiv = indiv[(indiv.cur_id != only) | (indiv.ex_id == small)]
+        if not (indiv.cur_id == only).any():
+            row = pd.DataFrame([{'cur_id': only, 'ex_id': small, 'price': 1.,
+                                 'val': 1e-9, 'bal': 1e-9, 'bal_tgt': np.nan}])
+            indiv = pd.concat([indiv, row], ignore_index=True)
+        funds = indiv.groupby('ex_id').val.sum()
+        pct[-1] = min(0.9, 2 * funds[small] / funds.sum())
+        pct[:-1] *= (1 - pct[-1]) / pct[:-1].sum()
+    indiv = indiv.set_index(['cur_id', 'ex_id']).sort_index()
+    comb = pd.DataFrame({'pct_tgt': pct, 'val_tgt': pct * indiv.val.sum()},
+                        index=pd.Index(cur_ids, name='cur_id'))
+    return indiv, comb
+
+
+def quality(indiv, comb, val_nnls, L1):
+    df = indiv.reset_index()
+    inc = layout_incidence(df)
+    vals = df.val.values
+    xc_funds = dict(zip(inc.ex_ids, inc.ex @ vals))
+    cur_res = inc.cur @ val_nnls - comb.val_tgt.loc[inc.cur_ids].values
+    if L1:
+        ex_res = inc.ex @ val_nnls - inc.ex @ vals
+    else:
+        ex_res = np.array([val_nnls.sum() - vals.sum()])
+    sol = df.copy()
+    sol['val_nnls'] = val_nnls
+    return {
+        'l1_distance': float(np.abs(val_nnls - vals).sum()),
+        'cur_residual': float(np.abs(cur_res).max()),
+        'ex_residual': float(np.abs(ex_res).max()),
+        'success': bool(verify_solution(sol, comb.val_tgt.to_dict(), xc_funds,
+                                        exchange_constraints=L1)),
+    }
+
+
+def run_backend(backend, indiv, comb, L1):
+    """ Solve one problem, returning (val_nnls or None, iterations or None).
+    """
+    if backend == 'regression':
+        regr = perform_regr if L1 else perform_regr_L2
+        return regr(indiv, comb, VAL_CUR).val_nnls.values.astype(float), None
+    df = indiv.reset_index()
+    xc_funds = df.groupby('ex_id').val.sum().to_dict()
+    sol_df, res = find_solutions(df, xc_funds, comb.val_tgt.to_dict(),
+                                 df.val.to_dict(), L1=L1, backend=backend)
+    if sol_df is None:
+        return None, None
+    return sol_df.val_nnls.values.astype(float), getattr(res, 'nit', None)
+
+
+def timed(f, *args):
+    def expire(signum, frame):
+        raise Timeout()
+    signal.signal(signal.SIGALRM, expire)
+    signal.alarm(TIMEOUT)
+    start = perf_counter()
+    try:
+        return f(*args), perf_counter() - start, 'ok'
+    except Timeout:
+        return None, perf_counter() - start, 'timeout'
+    except Exception as e:
+        return None, perf_counter() - start, repr(e)
+    finally:
+        signal.alarm(0)
+
+
+def bench(backends, currencies=CURRENCIES, exchanges=EXCHANGES, dust=DUST,
+          runs=RUNS, seed=SEED):
+    rng = np.random.default_rng(seed)
+    for n_cur, n_ex, d, infeasible, run in product(
+            currencies, exchanges, dust, [False, True], range(runs)):
+        indiv, comb = make_problem(rng, n_cur, n_ex, d, infeasible)
+        problem = {'currencies': n_cur, 'exchanges': n_ex, 'dust': d,
+                   'infeasible': infeasible, 'run': run, 'rows': len(indiv)}
+        for backend, L1 in product(backends, [True, False]):
+            result, elapsed, status = timed(run_backend, backend, indiv, comb, L1)
+            row = {**problem, 'backend': backend, 'mode': 'L1' if L1 else 'L2',
+                   'time': elapsed, 'status': status, 'iterations': None}
+            if result is not None and result[0] is not None:
+                val_nnls, row['iterations'] = result
+                row.update(quality(indiv, comb, val_nnls, L1))
+                if not L1 and n_ex > 1:
+                    yield from bench_transfers(problem, backend, indiv, val_nnls)
+            else:
+                row['success'] = False
+            yield row
+
+
+def bench_transfers(problem, backend, indiv, val_nnls):
+    df = indiv.reset_index()
+    df['val_nnls'] = val_nnls
+    df['bal_tgt'] = df.val_nnls / df.price
+    result, elapsed, status = timed(calculate_transfers, df)
+    row = {**problem, 'backend': backend, 'mode': 'transfers',
+           'time': elapsed, 'status': status, 'success': result is not None}
+    if result is not None:
+        row['transfers'] = len(result[1])
+    yield row
+
+
+def summarize(rows):
+    df = pd.DataFrame(rows)
+    summary = df.groupby(['backend', 'mode', 'currencies', 'exchanges']).agg(
+        time=('time', 'median'), success=('success', 'mean'))
+    print(summary.to_string(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    default_backends = ['highs', 'regression']
+    if os.path.exists(optimizer.SOLVER_PATH):
+        default_backends.insert(0, 'ipopt')
+    parser.add_argument('--backends', nargs='*', default=default_backends)
+    parser.add_argument('--currencies', nargs='*', type=int, default=CURRENCIES)
+    parser.add_argument('--exchanges', nargs='*', type=int, default=EXCHANGES)
+    parser.add_argument('--dust', nargs='*', type=float, default=DUST)
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--output', help='JSON lines file (default: stdout)')
+    args = parser.parse_args()
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    rows = []
+    for row in bench(args.backends, args.currencies, args.exchanges, args.dust,
+                     args.runs, args.seed):
+        rows.append(row)
+        out.write(json.dumps(row) + '\n')
+        out.flush()
+    summarize(rows)
@@ -1,6 +1,8 @@
 import os
 from celery import Celery
 from trader import run_trader
+from utils.markets import sync_markets
+from utils.schedule import rebuild_schedule
 from database import db_session
 
 REDIS_URI = os.getenv('REDIS_URI')
@@ -26,7 +28,23 @@ def setup_periodic_tasks(sender, **kwargs):
         600, # every 10 minutes
         run_all_trader,
         name='trade cubes')
+    sender.add_periodic_task(
+        3600, # every hour
+        sync_all_markets,
+        name='sync market metadata')
+    sender.add_periodic_task(
+        3600, # every hour
+        rebuild_trader_schedule,
+        name='rebuild trader schedule')
 
 @app.task(base=SqlAlchemyTask)
 def run_all_trader():
     run_trader()
+
+@app.task(base=SqlAlchemyTask)
+def sync_all_markets():
+    sync_markets()
+
+@app.task(base=SqlAlchemyTask)
+def rebuild_trader_schedule():
+    rebuild_schedule()
@@ -1,6 +1,11 @@
 import logging
-from collections import defaultdict
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from enum import Enum, auto
+from time import time
 from typing import Dict
 
 import numpy as np
@@ -10,15 +15,28 @@ import pyomo.environ
 from pyomo.core import ConcreteModel, Var, NonNegativeReals, Constraint, Objective
 from pyomo.opt import SolverFactory
 from pyutilib.common import ApplicationError
-from scipy.optimize import lsq_linear
+from scipy import sparse
+from scipy.optimize import lsq_linear, linprog, milp, LinearConstraint, Bounds
 
 SOLVER_PATH = '/opt/conda/bin/ipopt'
 SOLVE_TIME_LIMIT = 90
 SOLVE_MAX_ITERATIONS = 20000
+# 'ipopt' (pyomo model solved by the external binary) or 'highs' (in-process LP)
+SOLVER_BACKEND = os.getenv('SOLVER_BACKEND', 'ipopt')
+# Keep Ipopt close to a warm start instead of pushing it into the interior
+WARM_START_OPTIONS = {'mu_init': 1e-4, 'bound_push': 1e-8, 'bound_frac': 1e-8}
+SOLVE_WORKERS = int(os.getenv('SOLVE_WORKERS', os.cpu_count() or 1))
+INCIDENCE_CACHE_SIZE = 256  # Layouts whose constraint matrices are kept
+TRANSFER_FEE = 1.  # Cost of a transfer from an exchange without a known fee
+TRANSFER_DUST = 1e-9  # Planned amounts below this are not transfers
 
 
 log = logging.getLogger(__name__)
 
+# Sparse 0/1 membership of each (cur_id, ex_id) row: one matrix row per
+# exchange / currency, ids in order of appearance
+Incidence = namedtuple('Incidence', ['ex', 'ex_ids', 'cur', 'cur_ids'])
+
 
 class UseRegression(Enum):
     force = auto()
@@ -33,10 +51,73 @@ def solve_allocations(indiv, comb, val_cur, L1=True, **kwargs):
     return solve_L2(indiv, comb, val_cur, **kwargs)
 
 
+def solve(indiv, comb, val_cur, **kwargs):
+    """ Solve with exchange constraints (L1), falling back to total funds only (L2).
+    Returns (indiv, comb, mode) with mode 'L1', 'L2' or None if unsolved.
+    """
+    indiv_sol, comb_sol = solve_allocations(indiv, comb, val_cur, **kwargs)
+    if indiv_sol is not None:
+        return indiv_sol, comb_sol, 'L1'
+    indiv_sol, comb_sol = solve_allocations(indiv, comb, val_cur, L1=False, **kwargs)
+    if indiv_sol is not None:
+        return indiv_sol, comb_sol, 'L2'
+    return None, None, None
+
+
+def timed_solve(key, indiv, comb, val_cur, kwargs):
+    start = time()
+    try:
+        indiv, comb, mode = solve(indiv, comb, val_cur, **kwargs)
+        status = mode or 'failed'
+    except Exception:
+        log.exception(f'Solve failed for {key}')
+        indiv, comb, status = None, None, 'error'
+    val_nnls = indiv.val_nnls.values.astype(float) if indiv is not None else None
+    return key, val_nnls, status, time() - start
+
+
+def solve_many(problems, workers=SOLVE_WORKERS, **kwargs):
+    """ Solve many allocation problems in a process pool.
+
+    problems maps a key (e.g. cube id) to (indiv, comb, val_cur) or
+    (indiv, comb, val_cur, kwargs), the latter overriding the shared kwargs
+    for that problem (e.g. start_vals). Returns key -> dict with indiv and
+    comb as solve() returns them (None if unsolved), status ('L1', 'L2',
+    'failed' or 'error') and time (seconds spent solving).
+    """
+    tasks = []
+    for key, problem in problems.items():
+        indiv, comb, val_cur = problem[:3]
+        own = {**kwargs, **(problem[3] if len(problem) > 3 else {})}
+        # Only ship what the solvers read to the pool
+        tasks.append((key, indiv[['val']], comb[['val_tgt']], val_cur, own))
+
+    # Daemonic processes (e.g. Celery prefork workers) cannot have children
+    if workers > 1 and len(tasks) > 1 and not multiprocessing.current_process().daemon:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            solved = list(pool.map(timed_solve, *zip(*tasks)))
+    else:
+        solved = [timed_solve(*task) for task in tasks]
+
+    results = {}
+    for key, val_nnls, status, elapsed in solved:
+        indiv, comb = problems[key][:2]
+        indiv_sol = comb_sol = None
+        if val_nnls is not None:
+            # Solvers return rows in the order of indiv.reset_index()
+            indiv_sol, comb_sol = indiv.reset_index(), comb.copy()
+            indiv_sol['val_nnls'] = val_nnls
+        results[key] = {'indiv': indiv_sol, 'comb': comb_sol,
+                        'status': status, 'time': elapsed}
+        log.debug(f'Solved {key} ({status}) in {elapsed:.2f}s')
+    return results
+
+
 def solve_L2(indiv, comb, val_cur, use_regression=UseRegression.fallback,
-             solver_params=None, L1=False):
+             solver_params=None, L1=False, backend=None, start_vals=None):
     """ Tries to find individual allocations according to the comb requirements.
-    First, the function tries to find a solution using pyomo and Ipopt. If that fails,
+    First, the function tries to find a solution using the solver backend
+    (pyomo/Ipopt or HiGHS). If that fails,
     the regression function is tried. if that also fails, (None, None) is returned.
     """
     indiv, comb = indiv.copy(), comb.copy()
@@ -46,10 +127,11 @@ def solve_L2(indiv, comb, val_cur, use_regression=UseRegression.fallback,
     target_pct = comb.val_tgt.to_dict()
     cur_bals = indiv.reset_index().val.to_dict()
 
-    # find solution using pyomo
-    sol_df, sol = find_solutions(indiv, xc_funds, target_pct,
-                                 cur_bals, external_bals=None,
-                                 solver_params=solver_params, L1=L1)
+    backend = backend or SOLVER_BACKEND
+    sol_df, sol = find_solutions(indiv, xc_funds, target_pct, cur_bals,
+                                 start_vals=start_vals,
+                                 solver_params=solver_params, L1=L1,
+                                 backend=backend)
 
     if sol_df is not None and use_regression is not UseRegression.force:
         indiv_sol = indiv.set_index(['cur_id', 'ex_id'])
@@ -59,7 +141,7 @@ def solve_L2(indiv, comb, val_cur, use_regression=UseRegression.fallback,
         lp_success = verify_solution(indiv_sol, target_pct, xc_funds,
                                      exchange_constraints=L1)
         if lp_success:
-            log.debug("Found a solution using pyomo/ipopt.")
+            log.debug(f"Found a solution using {backend}.")
             return indiv_sol, comb
 
     lp_success = False
@@ -78,9 +160,10 @@ def solve_L2(indiv, comb, val_cur, use_regression=UseRegression.fallback,
 
 
 def solve_L1(indiv, comb, val_cur, use_regression=UseRegression.fallback,
-             solver_params=None, L1=True, ):
+             solver_params=None, L1=True, backend=None, start_vals=None):
     """ Tries to find individual allocations according to the comb requirements.
-    First, the function tries to find a solution using pyomo and Ipopt. If that fails,
+    First, the function tries to find a solution using the solver backend
+    (pyomo/Ipopt or HiGHS). If that fails,
     the regression function is tried. if that also fails, (None, None) is returned.
     """
     indiv, comb = indiv.copy(), comb.copy()
@@ -90,21 +173,21 @@ def solve_L1(indiv, comb, val_cur, use_regression=UseRegression.fallback,
     target_pct = comb.val_tgt.to_dict()
     cur_bals = indiv.reset_index().val.to_dict()
 
-    # find solution using pyomo
-    sol_df, sol = find_solutions(indiv, xc_funds, target_pct,
-                                 cur_bals, solver_params=solver_params, L1=L1)
+    backend = backend or SOLVER_BACKEND
+    sol_df, sol = find_solutions(indiv, xc_funds, target_pct, cur_bals,
+                                 start_vals=start_vals,
+                                 solver_params=solver_params, L1=L1,
+                                 backend=backend)
 
     lp_success = False
     if sol_df is not None and use_regression is not UseRegression.force:
-        indiv_sol = indiv_sep.set_index(['cur_id', 'ex_id'])
+        indiv_sol = indiv.set_index(['cur_id', 'ex_id'])
         indiv_sol['val_nnls'] = sol_df.val_nnls
-
         indiv_sol.reset_index(inplace=True)
-        del indiv_sol['index']
         lp_success = verify_solution(indiv_sol, target_pct, xc_funds,
                                      exchange_constraints=L1)
         if lp_success:
-            log.debug("Found a solution using pyomo/ipopt.")
+            log.debug(f"Found a solution using {backend}.")
             return indiv_sol, comb
 
     # try regression if no solution
@@ -122,9 +205,13 @@ def solve_L1(indiv, comb, val_cur, use_regression=UseRegression.fallback,
 
 def find_solutions(df, xc_funds, target_pct, cur_bals,
                    tee=False, start_vals=None,
-                   solver_params=None, L1=True):
-    """ Find solutions using pyomo / Ipopt.
+                   solver_params=None, L1=True, backend=None):
+    """ Find solutions using pyomo / Ipopt, or HiGHS if backend is 'highs'.
     """
+    if (backend or SOLVER_BACKEND) == 'highs':
+        # HiGHS (via linprog) takes no starting point; it solves from scratch
+        return find_solutions_lp(df, xc_funds, target_pct, cur_bals,
+                                 solver_params=solver_params, L1=L1)
 
     m = build_model(df, xc_funds, target_pct, cur_bals, L1_constraints=L1)
     if start_vals is not None:
@@ -136,6 +223,9 @@ def find_solutions(df, xc_funds, target_pct, cur_bals,
     opt.set_executable(name=SOLVER_PATH, validate=True)
     opt.options['max_cpu_time'] = SOLVE_TIME_LIMIT
     opt.options['max_iter'] = SOLVE_MAX_ITERATIONS
+    if start_vals is not None:
+        for k, v in WARM_START_OPTIONS.items():
+            opt.options[k] = v
     if solver_params is not None:
         for k, v in solver_params.items():
             opt.options[k] = v
@@ -154,6 +244,73 @@ def find_solutions(df, xc_funds, target_pct, cur_bals,
     return parse_solution(df, results)
 
 
+def find_solutions_lp(df, xc_funds, target_pct, cur_bals,
+                      solver_params=None, L1=True):
+    """ Find solutions with HiGHS, in process.
+
+    Minimizing sum(abs(bals - cur_bals)) is written as a linear program with
+    auxiliary variables t >= abs(bals - cur_bals). Variables are [bals, t].
+    """
+    df = df.reset_index()
+    n = len(df)
+    cur = np.array([float(cur_bals[i]) for i in range(n)])
+    eye = sparse.identity(n, format='csr')
+
+    # bals - t <= cur_bals and -bals - t <= -cur_bals
+    a_ub = sparse.bmat([[eye, -eye], [-eye, -eye]], format='csr')
+    b_ub = np.concatenate([cur, -cur])
+
+    inc = layout_incidence(df)
+    if L1:  # exchange sums shouldn't change
+        ex_a = inc.ex
+        ex_b = [float(xc_funds[x]) for x in inc.ex_ids]
+    else:  # just the total funds sum
+        ex_a = sparse.csr_matrix(np.ones((1, n)))
+        ex_b = [float(sum(xc_funds.values()))]
+    cur_b = [float(target_pct[c]) for c in inc.cur_ids]
+    a_eq = sparse.vstack([ex_a, inc.cur])
+    a_eq = sparse.hstack([a_eq, sparse.csr_matrix(a_eq.shape)], format='csr')
+    b_eq = np.array(ex_b + cur_b)
+
+    options = {'time_limit': SOLVE_TIME_LIMIT}
+    if solver_params is not None:
+        options.update(solver_params)
+    res = linprog(np.concatenate([np.zeros(n), np.ones(n)]),
+                  A_ub=a_ub, b_ub=b_ub, A_eq=a_eq, b_eq=b_eq,
+                  bounds=(0, None), method='highs', options=options)
+    if res.status != 0:
+        log.debug(f'HiGHS: {res.message}')
+        return None, None
+
+    rdf = pd.DataFrame({'val_nnls': res.x[:n]},
+                       index=df.set_index(['cur_id', 'ex_id']).index)
+    return rdf, res
+
+
+def incidence(ids):
+    codes, uniques = pd.factorize(np.asarray(ids))
+    a = sparse.csr_matrix((np.ones(len(codes)), (codes, np.arange(len(codes)))),
+                          shape=(len(uniques), len(codes)))
+    return a, list(uniques)
+
+
+@lru_cache(maxsize=INCIDENCE_CACHE_SIZE)
+def _layout_incidence(cur_ids, ex_ids):
+    ex, ex_uniques = incidence(ex_ids)
+    cur, cur_uniques = incidence(cur_ids)
+    return Incidence(ex, ex_uniques, cur, cur_uniques)
+
+
+def layout_incidence(df):
+    """ Exchange and currency incidence matrices of df's (cur_id, ex_id) rows.
+
+    Cached by layout, so treat the matrices as read only.
+    """
+    if 'cur_id' not in df.columns:
+        df = df.reset_index()
+    return _layout_incidence(tuple(df.cur_id.tolist()), tuple(df.ex_id.tolist()))
+
+
 def parse_solution(df, results):
     """ Convert pyomo solution object to a dataframe.
     """
@@ -179,33 +336,21 @@ def build_model(df, xc_funds, target_pct, cur_bals, L1_constraints=True):
     m = ConcreteModel()
     m.bals = Var(range(len(df)), domain=NonNegativeReals)
     df = df.reset_index()
-
-    currencies = df.cur_id.unique()
-
-    # create the model variables for currencies
-    for cur in currencies:
-        idx = np.where(df.cur_id == cur)[0]
-        m.__setattr__(f'c_{str(cur).lower()}_idx', Var(idx, domain=NonNegativeReals))
-
-    if L1_constraints:  # create the model variables for exchanges
-        for x in df.ex_id.unique():
-            idx = np.where(df.ex_id == x)[0]
-            m.__setattr__(f'x_{str(x).lower()}_idx', Var(idx, domain=NonNegativeReals))
+    inc = layout_incidence(df)
 
     m.indices = list(range(len(df)))
 
     if L1_constraints:
         # create the constraints that specify that excahnge sums shouldn't change
-        for x in df.ex_id.unique():
-            expr = sum(m.bals[i] for i in eval(f'm.x_{str(x).lower()}_idx')) == xc_funds[x]
+        for k, x in enumerate(inc.ex_ids):
+            expr = sum(m.bals[i] for i in inc.ex[k].indices) == xc_funds[x]
             m.__setattr__(f'x_{str(x).lower()}_constraint', Constraint(expr=expr))
     else:  # for non L1 optimization, just the total funds sum
         expr = sum(m.bals[i] for i in m.indices) == sum(xc_funds.values())
         m.__setattr__(f'xc_sum_constraint', Constraint(expr=expr))
 
-    for c in currencies:
-        expr = (sum(m.bals[i] for i in eval(f'm.c_{str(c).lower()}_idx'))
-                == target_pct[c])
+    for k, c in enumerate(inc.cur_ids):
+        expr = sum(m.bals[i] for i in inc.cur[k].indices) == target_pct[c]
         m.__setattr__(f'c_{str(c).lower()}_constraint', Constraint(expr=expr))
 
     m.obj = Objective(expr=sum(abs(m.bals[i] - cur_bals[i]) for i in m.indices), sense=1)
@@ -223,18 +368,18 @@ def verify_solution(sol_df: pd.DataFrame, cur_tgt: Dict,
 
     c = 'val_nnls' if 'val_nnls' in sol_df.columns else 'bals'
     sol_df['val_nnls'] = sol_df.val_nnls.astype('float')
-    bal_sums = sol_df.groupby('cur_id').sum()[c].to_dict()
+    inc = layout_incidence(sol_df)
+    vals = sol_df[c].values.astype(float)
+    bal_sums = dict(zip(inc.cur_ids, inc.cur @ vals))
 
     cur_success = all(np.isclose(bal, cur_tgt[cur], rtol=0.01, atol=0.01)
                       for cur, bal in bal_sums.items())
     if exchange_constraints:
-        ex_success = True
-        ex_bals = sol_df.groupby('ex_id').sum()[c]
-        for x in xc_funds.keys():
-            if abs(ex_bals.loc[x] - xc_funds[x]) > 0.01:
-                ex_success = False
+        ex_bals = dict(zip(inc.ex_ids, inc.ex @ vals))
+        ex_success = all(abs(ex_bals[x] - xc_funds[x]) <= 0.01
+                         for x in xc_funds.keys())
     else:
-        ex_success = np.isclose(sol_df.val_nnls.sum(), sum(xc_funds.values()))
+        ex_success = np.isclose(vals.sum(), sum(xc_funds.values()))
 
     return cur_success and ex_success
 
@@ -243,37 +388,18 @@ def perform_regr(indiv, comb, val_cur):
     """ Perform bounded linear regression using lsq_linear.
     """
     indiv, comb = indiv.copy(), comb.copy()
-    # determine exchange val totals
-    ex_tot = indiv.reset_index().groupby(
-        ['ex_id'])[['val']].sum()
-    a = []
-    b = []
     indiv = indiv.reset_index()
+    inc = layout_incidence(indiv)
     # create systems of equations
     # relating exchange currencies to exchange total
-    for ex_id in ex_tot.index:
-        # a is a list of ilocs for each exchange
-        a.append((indiv.ex_id == ex_id).astype(int).tolist())
-        # b is exchange total
-        b.append(ex_tot.val.loc[ex_id])
+    a = [inc.ex]
+    b = [inc.ex @ indiv.val.values.astype(float)]
     # relating individual currencies to their total target val
-    for cur_id in comb.index:
-        # skip bitcoin to prevent regression from overshooting targets
-        # if allocation is unbalanceable given exchange distribution
-        if cur_id == val_cur:
-            continue
-        # a is list of ilocs for each currency
-        a.append((indiv.cur_id == cur_id).astype(int).tolist())
-        # b is currency total target val
-        b.append(comb.val_tgt.loc[cur_id])
+    a_cur, b_cur = currency_rows(inc, comb, val_cur)
     # regression
-    a = np.array(a)
-    b = np.array(b)
-    s = lsq_linear(a, b, bounds=(0, np.inf))
-    # pprint(s)
-    s = [s['x']]
-    # print(['%.8f' % v for v in s[0]])
-    indiv['val_nnls'] = s[0]
+    s = lsq_linear(sparse.vstack(a + a_cur), np.concatenate(b + b_cur),
+                   bounds=(0, np.inf))
+    indiv['val_nnls'] = s['x']
     return indiv
 
 
@@ -282,83 +408,64 @@ def perform_regr_L2(indiv, comb, val_cur):
     """
     indiv, comb = indiv.copy(), comb.copy()
     indiv = indiv.reset_index()
-
-    a = []
-    b = []
+    inc = layout_incidence(indiv)
 
     ### create systems of equations
     # condition that total funds stay the same
-    a.append(list(np.ones(len(indiv))))
-    b.append(indiv.val.sum())
-
+    a = [sparse.csr_matrix(np.ones((1, len(indiv))))]
+    b = [np.array([indiv.val.sum()], dtype=float)]
     # relating individual currencies to their total target val
-    for cur_id in comb.index:
-        # skip bitcoin to prevent regression from overshooting targets
-        # if allocation is unbalanceable given exchange distribution
-        if cur_id == val_cur:
-            continue
-        # a is list of ilocs for each currency
-        a.append((indiv.cur_id == cur_id).astype(int).tolist())
-        # b is currency total target val
-        b.append(comb.val_tgt.loc[cur_id])
-
+    a_cur, b_cur = currency_rows(inc, comb, val_cur)
     # regression
-    a = np.array(a)
-    b = np.array(b)
-    s = lsq_linear(a, b, bounds=(0, np.inf))
+    s = lsq_linear(sparse.vstack(a + a_cur), np.concatenate(b + b_cur),
+                   bounds=(0, np.inf))
+    indiv['val_nnls'] = s['x']
+    return indiv
 
-    s = [s['x']]
 
-    indiv['val_nnls'] = s[0]
-    return indiv
+def currency_rows(inc, comb, val_cur):
+    # skip bitcoin to prevent regression from overshooting targets
+    # if allocation is unbalanceable given exchange distribution
+    rows = [k for k, cur_id in enumerate(inc.cur_ids)
+            if cur_id != val_cur and cur_id in comb.index]
+    if not rows:
+        return [], []
+    tgts = comb.val_tgt.loc[[inc.cur_ids[k] for k in rows]].values.astype(float)
+    return [inc.cur[rows]], [tgts]
 
-def calculate_transfers(df: pd.DataFrame):
+
+def calculate_transfers(df: pd.DataFrame, fees=None, minimums=None):
+    """ Plan transfers from exchanges with surplus to exchanges with deficit.
+
+    Solved as a transportation problem: each source exchange ships its whole
+    surplus, each destination receives its whole deficit, and every transfer
+    used costs the source's withdrawal fee (fees: ex_id -> val, default
+    TRANSFER_FEE, i.e. the number of transfers is minimized). A transfer
+    from an exchange is at least its withdrawal minimum (minimums:
+    ex_id -> val), unless that makes the problem infeasible.
+    """
+    if fees is None:
+        fees = {}
+    if minimums is None:
+        minimums = {}
     # calculate surplus / deficit for each exchange
     df = df.copy()
     df['diffs'] = df.val - df.val_nnls
-    exd = df.groupby('ex_id').diffs.sum()
+    exd = df.groupby('ex_id').diffs.sum().astype(float)
 
-    # sort source/destination exchanges according to
-    # deficit/surplus size, in order to minimize the
-    # number of transfers
-    srcs = exd[exd > 0].sort_values(ascending=False)
-    dests = (exd[exd < 0] * -1).sort_values(ascending=False)
+    srcs = exd[exd > 0]
+    dests = exd[exd < 0] * -1
     assert np.isclose(srcs.sum(), dests.sum())
 
-    transfers = defaultdict(list)
-
-    # calculate transfers
-    dest_exc = None
-    dest_funds = None
-
-    while len(srcs):
-        src_exc = srcs.index[0]
-        src_funds = srcs.pop(src_exc)
-
-        while True:
-            if dest_funds is None:
-                dest_exc = dests.index[0]
-                dest_funds = dests.pop(dest_exc)
-
-            if dest_funds > src_funds:
-                transfers['source_id'] += [src_exc]
-                transfers['dest_id'] += [dest_exc]
-                transfers['amount'] += [src_funds]
-                dest_funds -= src_funds
-                break
-
-            transfers['source_id'] += [src_exc]
-            transfers['dest_id'] += [dest_exc]
-            transfers['amount'] += [dest_funds]
-            src_funds -= dest_funds
-
-            if len(dests):
-                dest_exc = dests.index[0]
-                dest_funds = dests.pop(dest_exc)
-
-    transfers = pd.DataFrame(transfers,
-                columns=['source_id', 'dest_id', 'amount'])
-    assert np.isclose(transfers.amount.sum(), exd[exd > 0].sum())
+    transfers = pd.DataFrame(columns=['source_id', 'dest_id', 'amount'])
+    if len(srcs) and len(dests):
+        amounts = plan_transfers(srcs, dests, fees, minimums)
+        src, dest = np.nonzero(amounts > TRANSFER_DUST)
+        transfers = pd.DataFrame({'source_id': srcs.index[src],
+                                  'dest_id': dests.index[dest],
+                                  'amount': amounts[src, dest]},
+                                 columns=['source_id', 'dest_id', 'amount'])
+    assert np.isclose(transfers.amount.sum(), srcs.sum())
 
     df = df.reset_index().set_index(['cur_id', 'ex_id'])
     df['bal_diff'] = df['bal'] - df['bal_tgt']
@@ -370,3 +477,43 @@ def calculate_transfers(df: pd.DataFrame):
     sell_amounts.rename(columns=col_names, inplace=True)
 
     return sell_amounts, transfers, buy_amounts
+
+
+def plan_transfers(srcs, dests, fees, minimums):
+    """ Amount moved from each source (rows) to each destination (columns).
+    """
+    supply = srcs.values
+    # Match the float totals exactly
+    demand = dests.values * supply.sum() / dests.values.sum()
+    n_src, n_dest = len(supply), len(demand)
+    n = n_src * n_dest
+    cap = np.minimum.outer(supply, demand).ravel().astype(float)
+    fee = np.repeat([fees.get(x, TRANSFER_FEE) for x in srcs.index], n_dest)
+    least = np.repeat([minimums.get(x, 0) for x in srcs.index], n_dest).astype(float)
+
+    # Variables are [amounts, used] with amounts[i * n_dest + j] for i -> j
+    eye = sparse.identity(n, format='csr')
+    ships = sparse.kron(sparse.identity(n_src), np.ones((1, n_dest)))
+    receives = sparse.kron(np.ones((1, n_src)), sparse.identity(n_dest))
+    zeros = sparse.csr_matrix((n_src + n_dest, n))
+    flow = LinearConstraint(sparse.hstack([sparse.vstack([ships, receives]), zeros]),
+                            np.concatenate([supply, demand]),
+                            np.concatenate([supply, demand]))
+    # amount <= cap * used and amount >= minimum * used
+    upper = LinearConstraint(sparse.hstack([eye, -sparse.diags(cap)]), -np.inf, 0)
+    lower = LinearConstraint(sparse.hstack([eye, -sparse.diags(least)]), 0, np.inf)
+
+    # Tiny per-unit cost keeps amounts off unused routes
+    cost = np.concatenate([np.full(n, 1e-9), fee])
+    integrality = np.concatenate([np.zeros(n), np.ones(n)])
+    bounds = Bounds(np.zeros(2 * n), np.concatenate([cap, np.ones(n)]))
+    options = {'time_limit': SOLVE_TIME_LIMIT}
+    res = milp(cost, constraints=[flow, upper, lower], integrality=integrality,
+               bounds=bounds, options=options)
+    if res.x is None and least.any():
+        log.warning('Transfer minimums cannot be met, planning without them')
+        res = milp(cost, constraints=[flow, upper], integrality=integrality,
+                   bounds=bounds, options=options)
+    if res.x is None:
+        raise ValueError(f'No transfer plan: {res.message}')
+    return res.x[:n].reshape(n_src, n_dest)
@@ -1,30 +1,90 @@
-from utils.api import api_request
-from datetime import datetime
-
-from database import Cube, Exchange
-
-RUNS = 10
-
-cube = Cube.query.all()[0]
-exchanges = Exchange.query.filter_by(active=True).all()
-
-for ex in exchanges:
-    last = None
-    ex_name = ex.name + '/'  
-    print(f'Test api request limit for {ex_name}')
-    for i in range(RUNS):
-        print('Run number ', i)
-        current = datetime.utcnow()
-        print(current)
-        if last:
-            diff = current - last
-            print(f'{diff} seconds between queries')
-        last = current
-        result = api_request(
-                    cube,
-                    'GET',
-                    ex_name,
-                    'orderbook',
-                    None
-                    )
-        print(result['asks'][0][0])
\ No newline at end of file
+""" Calibrate per-exchange EXAPI rate limits.
+
+Sends bursts of requests at increasing rates (bypassing the shared limiter)
+and records the highest rate each exchange sustains without throttling
+(429/403/503). Results are scaled by a safety factor and stored in Redis,
+where every worker picks them up. Private limits are per API key.
+
+    python test_api_request_limits.py [--exchanges Binance Kraken] [--dry-run]
+"""
+import argparse
+from time import time, sleep
+
+from utils.api import send_request, get_api_creds
+from utils.limiter import DEFAULT_LIMITS, load_limits, save_limits
+from database import Cube, Connection, Exchange, ExPair
+
+RUNS = 10  # Requests per step
+RATES = [1, 2, 4, 8, 16, 32]  # Requests per second to try
+SAFETY = 0.8  # Fraction of the measured rate written to the config
+THROTTLED = [403, 429, 503]
+
+
+def measure(request_type, ex_name, endpoint, params, rates=RATES, runs=RUNS):
+    sustained = None
+    for rate in rates:
+        print(f'{ex_name} {endpoint}: {rate} req/s')
+        throttled = 0
+        start = time()
+        for i in range(runs):
+            # Pace requests evenly at the target rate
+            delay = start + i / rate - time()
+            if delay > 0:
+                sleep(delay)
+            # One attempt each, so throttling is counted rather than retried
+            r = send_request(request_type, ex_name, endpoint, params,
+                             limit=False, retries=1)
+            if r.status_code in THROTTLED:
+                throttled += 1
+        elapsed = time() - start
+        print(f'    {runs} requests in {elapsed:.2f}s, {throttled} throttled')
+        if throttled:
+            break
+        sustained = runs / elapsed
+        # Let the exchange's own bucket refill before the next step
+        sleep(runs / rate)
+    return sustained
+
+
+def calibrate(ex, rates=RATES, runs=RUNS, safety=SAFETY):
+    limits = {}
+    ex_pair = ExPair.query.filter_by(exchange_id=ex.id, active=True).first()
+    if ex_pair:
+        params = {'base': ex_pair.base_symbol, 'quote': ex_pair.quote_symbol}
+        rate = measure('GET', ex.name, '/orderbook', params, rates, runs)
+        if rate:
+            limits['public'] = {'rate': round(rate * safety, 2),
+                                'burst': max(1, int(rate * safety))}
+
+    conn = Connection.query.filter_by(exchange_id=ex.id, failed_at=None).first()
+    if conn:
+        cube = Cube.query.get(conn.cube_id)
+        creds = get_api_creds(cube, ex)
+        rate = measure('GET', ex.name, '/balances', creds, rates, runs)
+        if rate:
+            limits['private'] = {'rate': round(rate * safety, 2),
+                                 'burst': max(1, int(rate * safety))}
+    return limits
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--exchanges', nargs='*', help='Exchange names (default: all active)')
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--safety', type=float, default=SAFETY)
+    parser.add_argument('--dry-run', action='store_true', help='Print limits without saving')
+    args = parser.parse_args()
+
+    exchanges = Exchange.query.filter_by(active=True)
+    if args.exchanges:
+        exchanges = exchanges.filter(Exchange.name.in_(args.exchanges))
+
+    limits = load_limits()
+    for ex in exchanges.all():
+        print(f'Calibrating api request limits for {ex.name}')
+        measured = calibrate(ex, runs=args.runs, safety=args.safety)
+        limits[ex.name] = {**DEFAULT_LIMITS, **limits.get(ex.name, {}), **measured}
+        print(f'{ex.name}: {limits[ex.name]}')
+
+    if not args.dry_run:
+        save_limits(limits)
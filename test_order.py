@@ -0,0 +1,173 @@
+""" Order planning against fixed cubes.
+
+Expected orders and balance targets were produced by the
+row-by-row target_orders (before plan_orders), so changes to
+the planning are checked against that behaviour. Prices,
+markets and the pair index are faked; nothing touches the
+database or EXAPI.
+
+    python -m pytest -q test_order.py
+"""
+from decimal import Decimal as dec
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import order
+
+BINANCE = SimpleNamespace(id=1, name='Binance')
+EXTERNAL = SimpleNamespace(id=2, name='External')
+SYMBOLS = {1: 'BTC', 2: 'ETH', 3: 'LTC', 4: 'XRP', 5: 'USDT'}
+# id: (exchange, base_id, quote_id, midprice, min_amt, min_val, amt_precision)
+PAIRS = {
+    10: (BINANCE, 2, 1, dec('0.05'), 0.001, 0.0001, 3),
+    11: (BINANCE, 3, 1, dec('0.004'), 0.01, 0.0001, 2),
+    12: (BINANCE, 4, 1, dec('0.00002'), 1, 0.0001, None),
+    13: (BINANCE, 1, 5, dec('20000'), 0.0001, 10, 6),
+    14: (BINANCE, 3, 2, dec('0.08'), 0.01, 0.001, 2),
+    15: (BINANCE, 4, 2, dec('0.001'), 1, 0.001, 0),
+}
+
+
+class FakeSession:
+    def add(self, obj):
+        pass
+
+    def commit(self):
+        pass
+
+
+class FakeIndex:
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def refresh(self):
+        pass
+
+    def ex_pair(self, pair_id):
+        return self.pairs[pair_id]
+
+    def table(self):
+        return pd.DataFrame(
+            [(p.id, p.exchange.id, p.base_currency_id, p.quote_currency_id)
+             for p in self.pairs.values()],
+            columns=['ex_pair_id', 'ex_id', 'base_id', 'quote_id'])
+
+    def routes(self, quote_id):
+        rows = [(p.exchange.id, p.base_currency_id, p.id, False)
+                for p in self.pairs.values() if p.quote_currency_id == quote_id]
+        rows += [(p.exchange.id, p.quote_currency_id, p.id, True)
+                 for p in self.pairs.values() if p.base_currency_id == quote_id]
+        routes = pd.DataFrame(rows, columns=['ex_id', 'cur_id', 'pair_id', 'inverted'])
+        return routes.drop_duplicates(['ex_id', 'cur_id'])
+
+
+
+class Fixture:
+    """ A cube with balances (cur_id, ex, bal, bal_tgt) and its indiv/comb. """
+
+    def __init__(self, bals, algorithm='Centaur', threshold='1.5'):
+        self.curs = {i: SimpleNamespace(id=i, symbol=s) for i, s in SYMBOLS.items()}
+        self.pairs = {}
+        for pair_id, (ex, base, quote, price, min_amt, min_val, prec) in PAIRS.items():
+            self.pairs[pair_id] = SimpleNamespace(
+                id=pair_id, exchange=ex,
+                base_currency=self.curs[base], quote_currency=self.curs[quote],
+                base_currency_id=base, quote_currency_id=quote)
+        self.index = FakeIndex(self.pairs)
+        self.balances = [SimpleNamespace(currency_id=cur_id, exchange_id=ex.id,
+                                         currency=self.curs[cur_id], exchange=ex,
+                                         target=tgt)
+                         for cur_id, ex, bal, tgt in bals]
+        self.cube = SimpleNamespace(id=1, val_cur=self.curs[1], balances=self.balances,
+                                    threshold=dec(threshold),
+                                    algorithm=SimpleNamespace(name=algorithm))
+        # Valuation currency price of each currency (BTC pairs, BTC/USDT inverted)
+        btc = {1: 1.0, 5: 1 / float(PAIRS[13][3])}
+        btc.update({base: float(p[3]) for base, p in
+                    ((p[1], p) for p in PAIRS.values()) if p[2] == 1})
+        rows = [{'cur_id': cur_id, 'ex_id': ex.id, 'cur': self.curs[cur_id], 'ex': ex,
+                 'bal': float(bal), 'bal_tgt': np.nan if tgt is None else float(tgt),
+                 'price': btc[cur_id], 'val': float(bal) * btc[cur_id]}
+                for cur_id, ex, bal, tgt in bals]
+        self.indiv = pd.DataFrame(rows).set_index(['cur_id', 'ex_id']).sort_index()
+        self.comb = self.indiv.groupby(level='cur_id').agg({'val': 'sum', 'price': 'mean'})
+
+    def get_price(self, exchange, base, quote):
+        for ex, b, q, price, *_ in PAIRS.values():
+            if (ex.name, SYMBOLS[b], SYMBOLS[q]) == (exchange, base, quote):
+                return price
+        raise KeyError((exchange, base, quote))
+
+    def get_market(self, ex_pair):
+        _, _, _, _, min_amt, min_val, prec = PAIRS[ex_pair.id]
+        return {'min_amt': min_amt, 'min_val': min_val, 'amt_precision': prec}
+
+    def targets(self):
+        return [(b.currency_id, b.exchange_id, b.target) for b in self.balances]
+
+
+FIXTURES = {
+    # Primary pairs only, one currency below threshold, USDT via an inverted pair
+    'primary': lambda: Fixture([
+        (1, BINANCE, 1.0, 0.8), (2, BINANCE, 10, 14),
+        (4, BINANCE, 10000, 10050), (5, BINANCE, 2000, 4000),
+    ]),
+    # LTC surplus offsets the ETH deficit through LTC/ETH first
+    'secondary': lambda: Fixture([
+        (1, BINANCE, 1.0, 0.8), (2, BINANCE, 10, 14), (3, BINANCE, 100, 50),
+        (4, BINANCE, 10000, 10000),
+    ]),
+    # ETH left after LTC/ETH is less than the XRP deficit: XRP/ETH is skipped
+    'secondary_offset': lambda: Fixture([
+        (1, BINANCE, 1.0, 1.0), (2, BINANCE, 10, 0), (3, BINANCE, 10, 60),
+        (4, BINANCE, 0, 20000),
+    ]),
+    # Below trade minimum, no target, and an External balance
+    'untradeable': lambda: Fixture([
+        (1, BINANCE, 1.0, 0.9), (2, BINANCE, 10, 10.00001), (3, BINANCE, 50, None),
+        (2, EXTERNAL, 3, 1), (4, BINANCE, 100, 5100),
+    ]),
+    # No val_diff check: the XRP/ETH buy exceeds the ETH balance and is throttled
+    'sphinx': lambda: Fixture([
+        (1, BINANCE, 1.0, 0.8), (2, BINANCE, 10, 14), (3, BINANCE, 100, 50),
+        (4, BINANCE, 10000, 30000),
+    ], algorithm='Sphinx'),
+}
+
+EXPECTED = {
+    'primary': (
+        [(0.099, 20000.0, 13, 'sell'), (4.0, 0.05, 10, 'buy')],
+        [(1, 1, None), (2, 1, 14), (4, 1, None), (5, 1, 4000)]),
+    'secondary': (
+        [(50.0, dec('0.08'), 14, 'sell'), (50.0, 0.004, 11, 'sell'), (4.0, 0.05, 10, 'buy')],
+        [(1, 1, None), (2, 1, 14), (3, 1, 50), (4, 1, None)]),
+    'secondary_offset': (
+        [(50.0, dec('0.08'), 14, 'buy'), (10.0, 0.05, 10, 'sell'), (50.0, 0.004, 11, 'buy'),
+         (20000, 2e-05, 12, 'buy')],
+        [(1, 1, None), (2, 1, 0), (3, 1, 60), (4, 1, 20000)]),
+    'untradeable': (
+        [(5000, 2e-05, 12, 'buy')],
+        [(1, 1, None), (2, 1, None), (3, 1, None), (2, 2, None), (4, 1, 5100)]),
+    # Throttling raised a float/Decimal TypeError, which ended the
+    # secondary pass; XRP is then bought against BTC
+    'sphinx': (
+        [(50.0, dec('0.08'), 14, 'sell'), (50.0, 0.004, 11, 'sell'), (4.0, 0.05, 10, 'buy'),
+         (20000, 2e-05, 12, 'buy')],
+        [(1, 1, None), (2, 1, 14), (3, 1, 50), (4, 1, 30000)]),
+}
+
+
+@pytest.mark.parametrize('name', sorted(FIXTURES))
+def test_target_orders(monkeypatch, name):
+    fx = FIXTURES[name]()
+    monkeypatch.setattr(order, 'get_price', fx.get_price)
+    monkeypatch.setattr(order, 'get_market', fx.get_market)
+    monkeypatch.setattr(order, 'pair_index', fx.index)
+    monkeypatch.setattr(order, 'db_session', FakeSession())
+    orders = order.target_orders(fx.cube, fx.indiv, fx.comb, orders=[])
+    expected_orders, expected_targets = EXPECTED[name]
+    assert orders == expected_orders
+    assert fx.targets() == expected_targets
@@ -0,0 +1,160 @@
+""" Individual valuations against fixed cubes.
+
+Expected rows were produced by the per-balance calc_indiv loop
+(before the balances were loaded as columns), so changes to the
+valuation are checked against that behaviour. Balances, prices
+and the pair index are faked; nothing touches the database or
+EXAPI.
+
+    python -m pytest -q test_tools.py
+"""
+from decimal import Decimal as dec
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import tools
+
+BINANCE = SimpleNamespace(id=1, name='Binance')
+EXTERNAL = SimpleNamespace(id=2, name='External')
+SYMBOLS = {1: 'BTC', 2: 'ETH', 3: 'LTC', 4: 'XRP', 5: 'USDT', 6: 'ADA', 7: 'DOGE'}
+# id: (exchange, base_id, quote_id, midprice or None if the query fails, close)
+PAIRS = {
+    10: (BINANCE, 2, 1, dec('0.05'), dec('0.049')),
+    11: (BINANCE, 3, 1, dec('0.004'), dec('0.0041')),
+    12: (BINANCE, 4, 1, None, dec('0.000021')),
+    13: (BINANCE, 1, 5, dec('20000'), dec('19990')),
+    14: (BINANCE, 3, 2, dec('0.08'), dec('0.081')),
+    16: (BINANCE, 7, 1, dec('0.000002'), dec('0.000002')),
+    17: (EXTERNAL, 2, 1, dec('0.051'), dec('0.051')),
+}
+
+
+class FakeIndex:
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def ex_pair(self, pair_id):
+        return self.pairs[pair_id]
+
+    def quote_ids(self, ex_id):
+        return set(p.quote_currency_id for p in self.pairs.values() if p.exchange.id == ex_id)
+
+    def routes(self, quote_id):
+        rows = [(p.exchange.id, p.base_currency_id, p.id, False)
+                for p in self.pairs.values() if p.quote_currency_id == quote_id]
+        rows += [(p.exchange.id, p.quote_currency_id, p.id, True)
+                 for p in self.pairs.values() if p.base_currency_id == quote_id]
+        routes = pd.DataFrame(rows, columns=['ex_id', 'cur_id', 'pair_id', 'inverted'])
+        return routes.drop_duplicates(['ex_id', 'cur_id'])
+
+
+class Fixture:
+    """ A cube with balances (cur_id, ex, total, target) and allocations (symbol -> percent). """
+
+    def __init__(self, bals, allocations):
+        self.curs = {i: SimpleNamespace(id=i, symbol=s) for i, s in SYMBOLS.items()}
+        self.pairs = {}
+        for pair_id, (ex, base, quote, price, close) in PAIRS.items():
+            self.pairs[pair_id] = SimpleNamespace(
+                id=pair_id, exchange=ex,
+                base_currency=self.curs[base], quote_currency=self.curs[quote],
+                base_currency_id=base, quote_currency_id=quote,
+                get_close=lambda close=close: close)
+        self.index = FakeIndex(self.pairs)
+        self.balances = [SimpleNamespace(currency_id=cur_id, exchange_id=ex.id,
+                                         currency=self.curs[cur_id], exchange=ex,
+                                         total=dec(total),
+                                         target=None if tgt is None else dec(tgt))
+                         for cur_id, ex, total, tgt in bals]
+        self.cube = SimpleNamespace(
+            id=1, val_cur=self.curs[1], exchange=BINANCE, balances=self.balances,
+            allocations={sym: SimpleNamespace(percent=dec(pct))
+                         for sym, pct in allocations.items()})
+
+    def load_balances(self, cube):
+        return pd.DataFrame([{
+            'cur_id': b.currency_id, 'ex_id': b.exchange_id, 'bal': b.total,
+            'bal_tgt': b.target, 'cur': b.currency, 'ex': b.exchange,
+            'symbol': b.currency.symbol, 'ex_name': b.exchange.name,
+        } for b in self.balances], columns=['cur_id', 'ex_id', 'bal', 'bal_tgt', 'cur',
+                                             'ex', 'symbol', 'ex_name'])
+
+    def get_price(self, exchange, base, quote):
+        for ex, b, q, price, _ in PAIRS.values():
+            if (ex.name, SYMBOLS[b], SYMBOLS[q]) == (exchange, base, quote) and price:
+                return price
+        raise KeyError((exchange, base, quote))
+
+
+FIXTURES = {
+    'basic': lambda: Fixture([
+        (1, BINANCE, '1.5', '1'), (2, BINANCE, '10', '12'), (3, BINANCE, '100', None),
+    ], {'BTC': '0.5', 'ETH': '0.3', 'LTC': '0.2'}),
+    # USDT is priced through BTC/USDT
+    'inverted': lambda: Fixture([
+        (1, BINANCE, '1', '0.8'), (5, BINANCE, '5000', '9000'),
+    ], {'BTC': '0.5', 'USDT': '0.5'}),
+    # Unallocated dust is dropped unless it is a quote currency (ETH);
+    # allocated dust is kept (XRP, priced at the close as its query fails)
+    'dust': lambda: Fixture([
+        (1, BINANCE, '1', None), (2, BINANCE, '0', None), (3, BINANCE, '0.00000005', None),
+        (4, BINANCE, '0', '100'), (7, BINANCE, '0', None),
+    ], {'BTC': '0.9', 'ETH': '0', 'LTC': '0', 'XRP': '0.1', 'DOGE': '0'}),
+    # External dust is dropped, other External balances are valued
+    'external': lambda: Fixture([
+        (1, BINANCE, '1', None), (2, BINANCE, '2', None), (2, EXTERNAL, '3', '1'),
+        (3, EXTERNAL, '0', None),
+    ], {'BTC': '0.5', 'ETH': '0.4', 'LTC': '0.1'}),
+    # Balances without a pair to BTC on their exchange are ignored
+    'no_pair': lambda: Fixture([
+        (1, BINANCE, '1', None), (6, BINANCE, '5', None), (3, EXTERNAL, '2', None),
+        (3, BINANCE, '20', None),
+    ], {'BTC': '0.5', 'ADA': '0.1', 'LTC': '0.4'}),
+}
+
+# (cur_id, ex_id): (symbol, exchange, bal, bal_tgt, price, val)
+EXPECTED = {
+    'basic': {
+        (1, 1): ('BTC', 'Binance', 1.5, 1.0, 1.0, 1.5),
+        (2, 1): ('ETH', 'Binance', 10.0, 12.0, 0.05, 0.5),
+        (3, 1): ('LTC', 'Binance', 100.0, None, 0.004, 0.4),
+    },
+    'dust': {
+        (1, 1): ('BTC', 'Binance', 1.0, None, 1.0, 1.0),
+        (2, 1): ('ETH', 'Binance', 0.0, None, 0.05, 0.0),
+        (4, 1): ('XRP', 'Binance', 0.0, 100.0, 2.1e-05, 0.0),
+    },
+    'external': {
+        (1, 1): ('BTC', 'Binance', 1.0, None, 1.0, 1.0),
+        (2, 1): ('ETH', 'Binance', 2.0, None, 0.05, 0.1),
+        (2, 2): ('ETH', 'External', 3.0, 1.0, 0.051, 0.153),
+    },
+    'inverted': {
+        (1, 1): ('BTC', 'Binance', 1.0, 0.8, 1.0, 1.0),
+        (5, 1): ('USDT', 'Binance', 5000.0, 9000.0, 5e-05, 0.25),
+    },
+    'no_pair': {
+        (1, 1): ('BTC', 'Binance', 1.0, None, 1.0, 1.0),
+        (3, 1): ('LTC', 'Binance', 20.0, None, 0.004, 0.08),
+    },
+}
+
+
+def rows(indiv):
+    return {key: (r.cur.symbol, r.ex.name, r.bal, None if np.isnan(r.bal_tgt) else r.bal_tgt,
+                  r.price, r.val)
+            for key, r in zip(indiv.index, indiv.itertuples())}
+
+
+@pytest.mark.parametrize('name', sorted(FIXTURES))
+def test_calc_indiv(monkeypatch, name):
+    fx = FIXTURES[name]()
+    monkeypatch.setattr(tools, 'load_balances', fx.load_balances)
+    monkeypatch.setattr(tools, 'get_price', fx.get_price)
+    monkeypatch.setattr(tools, 'pair_index', fx.index)
+    indiv = tools.calc_indiv(fx.cube)
+    assert list(indiv.index) == sorted(EXPECTED[name])
+    assert rows(indiv) == EXPECTED[name]
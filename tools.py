@@ -1,8 +1,8 @@
 from decimal import Decimal as dec
 import pandas as pd
-from sqlalchemy.orm.exc import NoResultFound
 
 from utils.api import get_price
+from utils.pairs import pair_index
 from database import *
 
 DUST_AMOUNT = 9e-8
@@ -43,45 +43,28 @@ def update_cube_cache(cube_id, processing):
 
 
 def get_ex_pair(ex, base, quote):
-    ex_pair = ExPair.query.filter_by(
-        active=True,
-        exchange_id=ex.id
-    )
-    try:
-        ex_pair = ex_pair.filter_by(
-            quote_currency_id=quote.id,
-            base_currency_id=base.id,
-        ).one()
-        inverted = False
-    except NoResultFound:
-        try:
-            ex_pair = ex_pair.filter_by(
-                base_currency_id=quote.id,
-                quote_currency_id=base.id,
-            ).one()
-            inverted = True
-        except NoResultFound:
-            raise ValueError(f'No ExPair involving {base} \
-                             and {quote} on {ex}')
+    found = pair_index.find(ex.id, base.id, quote.id)
+    if found is None:
+        raise ValueError(f'No ExPair involving {base} \
+                         and {quote} on {ex}')
+    ex_pair, inverted = found
     log.debug(f'{ex_pair} inverted={inverted}')
     return ex_pair, inverted
 
 
 def get_ex_pairs(exs, base, quote=None, inverts=True):
-    query = ExPair.query.filter_by(active=True).filter(
-                ExPair.exchange_id.in_([e.id for e in exs]))
     ex_pairs = []
-    res = query.filter_by(base_currency_id=base.id)
-    if quote:
-        res = res.filter_by(quote_currency_id=quote.id)
-    res = res.all()
-    ex_pairs.extend([(r, False) for r in res])
+    for ex in exs:
+        for ex_pair in pair_index.touching(ex.id, base.id):
+            if (ex_pair.base_currency_id == base.id and
+                    (not quote or ex_pair.quote_currency_id == quote.id)):
+                ex_pairs.append((ex_pair, False))
     if inverts:
-        res = query.filter_by(quote_currency_id=base.id)
-        if quote:
-            res = res.filter_by(base_currency_id=quote.id)
-        res = res.all()
-        ex_pairs.extend([(r, True) for r in res])
+        for ex in exs:
+            for ex_pair in pair_index.touching(ex.id, base.id):
+                if (ex_pair.quote_currency_id == base.id and
+                        (not quote or ex_pair.base_currency_id == quote.id)):
+                    ex_pairs.append((ex_pair, True))
     return ex_pairs
 
 
@@ -174,63 +157,80 @@ def sanity_check(cube):
     return True
 
 
+def load_balances(cube):
+    # Cube balances as columns, with Currency/Exchange objects for the frame
+    bals = pd.DataFrame(db_session.query(
+        Balance.currency_id, Balance.exchange_id, Balance.total, Balance.target,
+    ).filter_by(cube_id=cube.id).all(), columns=['cur_id', 'ex_id', 'bal', 'bal_tgt'])
+    curs = {c.id: c for c in Currency.query.filter(
+        Currency.id.in_(bals.cur_id.unique().tolist())).all()}
+    exs = {e.id: e for e in Exchange.query.filter(
+        Exchange.id.in_(bals.ex_id.unique().tolist())).all()}
+    bals['cur'] = bals.cur_id.map(curs)
+    bals['ex'] = bals.ex_id.map(exs)
+    bals['symbol'] = bals.cur_id.map({i: c.symbol for i, c in curs.items()})
+    bals['ex_name'] = bals.ex_id.map({i: e.name for i, e in exs.items()})
+    return bals
+
+
+def price_pairs(cube, pair_ids):
+    # Midprice for each pair id (one lookup per pair, not per balance)
+    prices = {}
+    for pair_id in pair_ids:
+        ex_pair = pair_index.ex_pair(pair_id)
+        try:
+            quote_symbol = ex_pair.quote_currency.symbol
+            base_symbol = ex_pair.base_currency.symbol
+            prices[pair_id] = get_price(ex_pair.exchange.name, base_symbol, quote_symbol)
+        except Exception as e:
+            log.warning(f'{cube} Price query failed for {ex_pair}')
+            log.warning(e)
+            prices[pair_id] = ex_pair.get_close()
+    return prices
+
+
 def calc_indiv(cube):
-    quotes = []
-    ex_pairs = ExPair.query.filter_by(
-        exchange_id=cube.exchange.id,
-        active=True
-        ).all()
-    for ex_pair in ex_pairs:
-        if ex_pair.quote_currency not in quotes:
-            quotes.append(ex_pair.quote_currency)
-
-    indiv = []
-    for bal in cube.balances:
-        i = {
-            'cur_id': bal.currency.id,
-            'cur': bal.currency,
-            'ex': bal.exchange,
-            'ex_id': bal.exchange.id,
-            'bal': bal.total,
-            'bal_tgt': bal.target
-        }
-        if bal.currency == cube.val_cur:
-            i['price'] = 1
-            i['val'] = i['bal']
-        else:
-            if ((i['bal'] <= DUST_AMOUNT) and
-                    not cube.allocations[bal.currency.symbol].percent and
-                    i['cur'].symbol != cube.val_cur.symbol):
-                if bal.currency in quotes:
-                    # Do not ignore quote currencies
-                    log.debug('[Cube %d] Not ignoring unallocated zero balance %s (quote currency)' %
-                              (cube.id, i['cur']))
-                else:
-                    # No balance, not allocated, and not a routed currency
-                    continue
-            if (i['bal'] <= DUST_AMOUNT) and (i['ex'].name in ['External', 'Manual']):
-                log.debug('%s Ignoring External and Manual zero balance %s'
-                          % (cube, i['cur']))
-                continue
-            try:
-                ex_pair, inverted = get_ex_pair(bal.exchange, bal.currency, cube.val_cur)
-            except ValueError as e:
-                log.warning('[Cube %d] Ignoring %f balance (%s)' %
-                         (cube.id, i['bal'], e.args[0]))
-                continue
-            try:
-                quote_symbol = ex_pair.quote_currency.symbol
-                base_symbol = ex_pair.base_currency.symbol
-                i['price'] = get_price(ex_pair.exchange.name, base_symbol, quote_symbol)
-            except Exception as e:
-                log.warning(f'{cube} Price query failed for {ex_pair}')
-                log.warning(e)
-                i['price'] = ex_pair.get_close()
-            if inverted:
-                i['price'] = 1 / i['price']
-            i['val'] = i['bal'] * i['price']
-        indiv.append(i)
-    indiv = pd.DataFrame(indiv)
+    val_cur = cube.val_cur
+    bals = load_balances(cube)
+    is_val = (bals.cur_id == val_cur.id).values
+    dust = (bals.bal.values <= DUST_AMOUNT)
+    allocated = bals.symbol.map(
+        {sym: bool(a.percent) for sym, a in cube.allocations.items()}
+    ).fillna(False).values.astype(bool)
+    quote = bals.cur_id.isin(pair_index.quote_ids(cube.exchange.id)).values
+
+    # No balance, not allocated, and not a routed currency
+    unallocated = ~is_val & dust & ~allocated & (bals.symbol != val_cur.symbol).values
+    for cur in bals.cur[unallocated & quote]:
+        # Do not ignore quote currencies
+        log.debug('[Cube %d] Not ignoring unallocated zero balance %s (quote currency)' %
+                  (cube.id, cur))
+    external = ~is_val & dust & bals.ex_name.isin(['External', 'Manual']).values
+    for cur in bals.cur[external & ~(unallocated & ~quote)]:
+        log.debug('%s Ignoring External and Manual zero balance %s'
+                  % (cube, cur))
+    bals = bals[~(unallocated & ~quote) & ~external]
+
+    # Join non val_cur balances against their pair to val_cur
+    bals = bals.merge(pair_index.routes(val_cur.id), how='left', on=['ex_id', 'cur_id'])
+    is_val = (bals.cur_id == val_cur.id).values
+    no_pair = ~is_val & bals.pair_id.isnull().values
+    for _, i in bals[no_pair].iterrows():
+        log.warning('[Cube %d] Ignoring %f balance (%s)' %
+                    (cube.id, i.bal, f'No ExPair involving {i.cur} and {val_cur} on {i.ex}'))
+    bals = bals[~no_pair]
+    is_val = (bals.cur_id == val_cur.id).values
+
+    prices = price_pairs(cube, bals.pair_id[~is_val].drop_duplicates().astype(int))
+    price = bals.pair_id.map(lambda pair_id: prices.get(pair_id, 1)).astype(object)
+    inverted = (bals.inverted == True).values
+    price[inverted] = 1 / price[inverted]
+    price[is_val] = 1
+    bals['price'] = price
+    bals['val'] = bals.bal * bals.price
+    bals.loc[is_val, 'val'] = bals.bal[is_val]
+
+    indiv = bals[['cur_id', 'cur', 'ex', 'ex_id', 'bal', 'bal_tgt', 'price', 'val']].copy()
     indiv['price'] = indiv['price'].astype(float)
     indiv['bal'] = indiv['bal'].astype(float)
     indiv['bal_tgt'] = indiv['bal_tgt'].astype(float)
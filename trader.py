@@ -1,20 +1,37 @@
 #!/usr/bin/env python3
+from contextlib import ExitStack
 from pprint import pformat
 from threading import Event
 from celery import Celery, group, chain
 from celery.exceptions import SoftTimeLimitExceeded
 
-from tools import (sanity_check, calc_indiv, calc_comb, update_cube_cache)
+from tools import sanity_check, calc_indiv, calc_comb
 from utils.api import api_request, get_api_creds
-from utils.order import cancel_order, place_order, target_orders
+from utils.async_api import USE_ASYNC_API, api_requests
+from utils.pairs import pair_index
+from utils.order import (cancel_order, place_order, target_orders,
+                         cancel_orders_concurrently, place_orders_concurrently)
 from utils.reconcile import reconcile_balances, reconcile_order
-from utils.regression import regression
+from utils.history import (import_stream, import_pair_streams, traded_pairs,
+                           trade_rows, transfer_rows)
+from utils.regression import regression_batch
+from utils.schedule import (active_filter, schedule, schedule_cube,
+                            sync_schedule, pop_due)
+from utils.routing import route_task, cube_queue, exchange_queue
+from utils.cache import price_snapshot
+from utils.markets import load_markets
+from utils.lease import (LEASE_TTL, Heartbeat, acquire, renew, release,
+                         leased)
 from database import *
 import numpy as np
 # Replacing datetime.time (Do not move)
 from time import time, sleep
 
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL')
+# Due cubes on the same exchange processed by one task (1 disables batching)
+EXCHANGE_BATCH_SIZE = int(os.getenv('EXCHANGE_BATCH_SIZE', 10))
+# Seconds a batch task works before handing its remaining cubes back to the scheduler
+EXCHANGE_BATCH_BUDGET = int(os.getenv('EXCHANGE_BATCH_BUDGET', 600))
 CELERY_RESULT_BACKEND = CELERY_BROKER_URL
 
 celery = Celery('trader', backend=CELERY_RESULT_BACKEND, broker=CELERY_BROKER_URL)
@@ -22,7 +39,10 @@ celery.conf.broker_transport_options = {'fanout_prefix': True}
 celery.conf.broker_transport_options = {'fanout_patterns': True}
 celery.conf.worker_prefetch_multiplier = 1
 celery.conf.task_time_limit = 1800
-celery.conf.task_soft_time_limit = 12000
+# Below the hard limit, so a task can release its leases before it is killed
+celery.conf.task_soft_time_limit = 1500
+# Per exchange queues, see utils.routing for worker settings
+celery.conf.task_routes = (route_task,)
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -39,34 +59,56 @@ class SqlAlchemyTask(celery.Task):
         db_session.remove()   
 
 @celery.task(base=SqlAlchemyTask)
-def place_orders(cube_id, orders):
+def place_orders(cube_id, orders, token=None):
+    # Last link of the process_cube chain, releases the lease
     try:
         cube = Cube.query.get(cube_id)
+        if token and not renew(cube_id, token):
+            # Expired while queued, another run may be reconciling the cube
+            log.warning(f'{cube} Lease lost (not placing orders)')
+            return
         log.debug(f'{cube} Placing Orders')
-        for order in orders:
-            # Arguments: cube_id, ex_pair_id, side, amount, price
-            place_order(cube_id, order[2], order[3], order[0], order[1])
-        update_cube_cache(cube_id, False) 
+        with Heartbeat(cube_id, token):
+            if USE_ASYNC_API:
+                place_orders_concurrently(cube, orders)
+            else:
+                for order in orders:
+                    # Arguments: cube_id, ex_pair_id, side, amount, price
+                    place_order(cube_id, order[2], order[3], order[0], order[1])
+        release(cube_id, token)
+        schedule_cube(cube)
     except SoftTimeLimitExceeded:
-        update_cube_cache(cube_id, False)  
+        release(cube_id, token)
         ## To do: error handling  
+    except Exception:
+        release(cube_id, token)
+        raise
 
 @celery.task(base=SqlAlchemyTask)
-def cancel_orders(cube_id, ex, orders):
+def cancel_orders(cube_id, ex, orders, token=None):
     try:
         cube = Cube.query.get(cube_id)
         log.debug(f'{cube} Canceling Orders')
-        for order in orders:
-            cancel_order(cube_id, 
-                        ex.id, 
-                        order['order_id'], 
-                        order['base'],
-                        order['quote']
-                        )
-        update_cube_cache(cube_id, False) 
+        if USE_ASYNC_API:
+            cancel_orders_concurrently(cube, ex, [
+                (order['order_id'], order['base'], order['quote'])
+                for order in orders
+            ])
+        else:
+            for order in orders:
+                cancel_order(cube_id, 
+                            ex.id, 
+                            order['order_id'], 
+                            order['base'],
+                            order['quote']
+                            )
+        release(cube_id, token)
     except SoftTimeLimitExceeded:
-        update_cube_cache(cube_id, False)  
+        release(cube_id, token)
         ## To do: error handling  
+    except Exception:
+        release(cube_id, token)
+        raise
 
 
 #### Not implemented yet
@@ -101,257 +143,36 @@ def trigger_rebalance(cube_id):
         db_session.add(cube)
         db_session.commit()
     except SoftTimeLimitExceeded:
-        update_cube_cache(cube_id, False)  
         ## To do: error handling
+        pass
 
-def get_start_timestamp(cube, db_tx):
-    if db_tx:
-        log.debug(f'{cube} Tranasactions exist, updating from {db_tx.timestamp}')
-        return int(float(db_tx.timestamp)) + 1
-    else:
-        log.debug(f'{cube} Transactions do not exist, updating from account start')
-        return int(datetime.timestamp(cube.created_at) * 1000) # Convert to milliseconds
-
-
-def import_trades(cube, ex, creds, since):
-    now = time() * 1000
-    days = 10
-    trades = pd.DataFrame()
+def import_trades(cube, ex, creds):
     url = '/trades'
-
     if ex.name in ['Binance', 'Liquid']:
-        while since < now:
-            new_trades = pd.DataFrame()
-            for bal in cube.balances:
-                ex_pairs = ExPair.query.filter_by(
-                            exchange_id=ex.id, active=True
-                            ).filter(or_(
-                                ExPair.base_currency_id == bal.currency_id,
-                                ExPair.quote_currency_id == bal.currency_id,
-                            )).all()
-                for ex_pair in ex_pairs:
-                    args = {**creds, 
-                        **{
-                            'base': ex_pair.base_symbol,
-                            'quote': ex_pair.quote_symbol,
-                            'limit': 1000,
-                            'since': since
-                        }
-                    }
-                    binance_trades = api_request(cube, 'GET', ex.name, url, args)
-                    binance_trades = pd.read_json(binance_trades)
-                    new_trades = new_trades.append(binance_trades)
-                    sleep(1)
-            if not new_trades.empty:
-                new_trades = new_trades.sort_index()
-                new_trades.timestamp = new_trades.timestamp.astype(np.int64)//10**6
-                since = int(new_trades.iloc[-1].timestamp) + 1
-                trades = trades.append(new_trades)
-            elif since < now:
-                # 10 days in milliseconds
-                since = since + 24 * 60 * 60 * days * 1000
-            else:
-                break
-
+        # Trades are only listed per pair
+        pairs = {f'{ep.base_symbol}/{ep.quote_symbol}': {
+                    'base': ep.base_symbol,
+                    'quote': ep.quote_symbol,
+                    'limit': 1000,
+                }
+                for ep in traded_pairs(cube, ex)}
+        import_pair_streams(cube, ex, 'trades', url, creds, pairs, trade_rows)
     else:
-        while since < now:
-            args = {**creds, **{'since': since}}
-            new_trades = api_request(cube, 'GET', ex.name, url, args)
-            new_trades = pd.read_json(new_trades)
-            if not new_trades.empty:
-                new_trades.timestamp = new_trades.timestamp.astype(np.int64)//10**6
-                since = new_trades.iloc[-1].timestamp + 1
-                trades = trades.append(new_trades)
-            elif since < now:
-                # 10 days in milliseconds
-                since = since + 24 * 60 * 60 * days * 1000
-            else:
-                break
-
-    if not trades.empty:
-        # Adjustments to dataframe to match table structure
-        fee = trades['fee'].apply(pd.Series)
-        try:
-            fee = fee.drop(['type'], axis=1)
-        except:
-            pass
-        try:
-            fee = fee.rename(index=str, columns={'rate': 'fee_rate', 'cost': 'fee_amount', 'currency': 'fee_currency'})
-        except:
-            pass
-        trades = pd.concat([trades, fee], axis=1)
-        trades = trades.rename(index=str, columns={'id': 'tx_id', 'order': 'order_id', 'amount': 'base_amount', 'cost': 'quote_amount'})
-        symbol = trades['symbol'].str.split('/', n=1, expand=True)
-        trades['base_symbol'] = symbol[0]
-        trades['quote_symbol'] = symbol[1]
-        trades['trade_type'] = trades['type']
-        trades['type'] = trades['side']
-        trades.drop(['side', 'symbol', 'fee'], axis=1, inplace=True)
-        _, i = np.unique(trades.columns, return_index=True)
-        trades = trades.iloc[:, i]
-        trades = trades.fillna(value=0)
-
-        # Add trades to database
-        log.debug(f'{cube} Writing trades to database')
-        for index, row in trades.iterrows():
-            if row.trade_type != 0:
-                trade_type = row.trade_type
-            else:
-                trade_type = None
-            ex_pair = ExPair.query.filter_by(
-                        exchange_id=ex.id,
-                        quote_symbol=row.quote_symbol,
-                        base_symbol=row.base_symbol,
-                        ).first()
-            if not ex_pair:
-                continue
-            if not row.base_amount:
-                continue
-            trade = Transaction(
-                    tx_id=row.tx_id,
-                    datetime=index[0:19],
-                    order_id=row.order_id,
-                    type=row.type,
-                    trade_type=trade_type,
-                    price=row.price,
-                    base_symbol=row.base_symbol,
-                    quote_symbol=row.quote_symbol,
-                    exchange=ex,
-                    cube=cube,
-                    user=cube.user,
-                )
-            db_session.add(trade)
-            db_session.commit()
-            db_session.refresh(trade)
-            if row.type == 'buy':
-                trade.base_amount = row.base_amount
-                trade.quote_amount = -row.quote_amount
-            elif row.type == 'sell':
-                trade.base_amount = -row.base_amount
-                trade.quote_amount = row.quote_amount                
-            try:
-                trade.fee_rate = row.fee_rate
-                trade.fee_amount = row.fee_amount
-                trade.fee_currency = row.fee_currency
-            except Exception:
-                pass
-            db_session.add(trade)
-            db_session.commit()
+        import_stream(cube, ex, 'trades', url, creds, trade_rows)
 
 
-def import_transactions(cube, ex, creds, since):
-    now = time() * 1000
-    trans = pd.DataFrame()
-    url = '/transactions'
-    old_since = 0
-
-    while since < now:
-        args = {**creds, **{'since': since}}
-        new_trans = api_request(cube, 'GET', ex.name, url, args)
-        if not new_trans:
-            break
-        new_trans = pd.read_json(new_trans)
-        if not new_trans.empty:
-            new_trans.timestamp = new_trans.timestamp.astype(np.int64)//10**6
-            since = new_trans.iloc[-1].timestamp + 1
-            if old_since == since:
-                break
-            old_since = since
-            trans = trans.append(new_trans)
-        elif since < now:
-            # 10 days in milliseconds
-            since = since + 24 * 60 * 60 * days * 1000
-        else:
-            break   
-
-    if not trans.empty:
-        log.debug(f'{cube} Adjusting dataframe to match table structure')
-        # Adjustments to dataframe to match table structure
-        if trans['fee'].any():
-            fee = trans['fee'].apply(pd.Series)
-            try:
-                fee = fee.rename(index=str, columns={'rate': 'fee_rate', 'cost': 'fee_amount'})
-                trans = pd.concat([trans, fee], axis=1)
-            except:
-                log.debug(f'{cube} missing transaction fee information, skipping...')
-            trans.drop(['fee'], axis=1, inplace=True)
-        trans = trans.rename(index=str, columns={'id': 'tx_id', 'txid': 'order_id'})
-        trans.drop(['status', 'updated', 'timestamp'], axis=1, inplace=True)
-        _, i = np.unique(trans.columns, return_index=True)
-        trans = trans.iloc[:, i]
-        trans = trans.fillna(value=0)
-
-        # Add transactions to database
-        log.debug(f'{cube} Writing transactions to database')
-        for index, row in trans.iterrows():
-            if not row.amount:
-                continue
-            cur = Currency.query.filter_by(symbol=row.currency).first()
-            if not cur:
-                continue
-            if row.type not in ['deposit', 'withdrawal', 'withdraw']:
-                continue
-            if row.type == 'withdraw':
-                t_type = 'withdrawal'
-            else:
-                t_type = row.type
-
-            ex_pair = ExPair.query.filter_by(
-                        exchange_id=ex.id,
-                        base_currency_id=cur.id,
-                        ).first()
-            if t_type == 'deposit':
-                base_amount = row.amount
-            elif t_type == 'withdrawal':
-                base_amount = -row.amount
-            quote_amount = 0
-            if not ex_pair:
-                ex_pair = ExPair.query.filter_by(
-                        exchange_id=ex.id,
-                        quote_currency_id=cur.id,
-                        ).first()
-                base_amount = 0
-                if t_type == 'deposit':
-                    quote_amount = row.amount
-                elif t_type == 'withdrawal':
-                    quote_amount = -row.amount
-
-            tx = Transaction(
-                    tx_id=row.tx_id,
-                    datetime=index[0:19],
-                    order_id=row.order_id,
-                    tag=row.tag,
-                    base_amount=base_amount,
-                    quote_amount=quote_amount,
-                    type=t_type,
-                    trade_type=None,
-                    base_symbol=ex_pair.base_currency.symbol,
-                    quote_symbol=ex_pair.quote_currency.symbol,
-                    exchange=ex,
-                    cube=cube,
-                    user=cube.user,
-                )
-            db_session.add(tx)
-            db_session.commit()
+def import_transactions(cube, ex, creds):
+    import_stream(cube, ex, 'transactions', '/transactions', creds, transfer_rows)
 
 
 def update_transactions(cube, creds):
     log.debug(f'{cube} Updating transactions')
-    db_tx = Transaction.query.filter_by(
-                    cube_id=cube.id
-                    ).order_by(
-                    Transaction.id.desc()
-                    ).first()
-
     try:
-        ts = get_start_timestamp(cube, db_tx)
-        log.debug(f'{cube} Get Transactions from {ts}')
-        import_transactions(cube, cube.exchange, creds, ts)
+        import_transactions(cube, cube.exchange, creds)
     except Exception as e:
         log.debug(e)
     try:
-        log.debug(f'{cube} Get Trades from {ts}')
-        import_trades(cube, cube.exchange, creds, ts)
+        import_trades(cube, cube.exchange, creds)
     except Exception as e:
         log.debug(e)
         return False
@@ -410,13 +231,7 @@ def order_reconciliation(cube, ex, creds, bals):
         for bal in cube.balances:
             if bal.total > bal.available:
                 # Part of balance has been reserved due to an open trade
-                ex_pairs = ExPair.query.filter_by(
-                        exchange_id=ex.id,
-                        active=True
-                    ).filter(or_(
-                        ExPair.base_currency_id == bal.currency_id,
-                        ExPair.quote_currency_id == bal.currency_id,
-                    )).all()
+                ex_pairs = pair_index.touching(ex.id, bal.currency_id)
                 # Check all possible pairs
                 log.debug(f'{cube} Checking for rogue orders (API)')
                 for ex_pair in ex_pairs:
@@ -433,6 +248,75 @@ def order_reconciliation(cube, ex, creds, bals):
                         db_session.commit()                          
 
 
+def order_reconciliation_concurrently(cube, ex, creds, bals):
+    # Same as order_reconciliation, but independent requests are sent together
+    log.debug(f'{cube} Reconciling database orders (API)')
+    if cube.orders:
+        cube_orders = [order for order in cube.orders.copy()
+                       if order.ex_pair.exchange.name == ex.name]
+        to_cancel = []
+        requests = []
+        for order in cube_orders:
+            quote_symbol = order.ex_pair.quote_currency.symbol
+            base_symbol = order.ex_pair.base_currency.symbol
+            args = {**creds, **{'base': base_symbol, 'quote': quote_symbol}}
+            requests.append(('GET', ex.name, f'/order/{order.order_id}', args))
+            to_cancel.append((order.order_id, base_symbol, quote_symbol))
+        ex_orders = api_requests(cube, ex, requests)
+        for (order_id, _, _), ex_order in zip(to_cancel, ex_orders):
+            if ex_order and ex_order != 'InvalidOrder':
+                # Reconcile order
+                reconcile_order(cube, ex, order_id, ex_order, bals)
+        # Cancel oustanding orders
+        cancel_orders_concurrently(cube, ex, to_cancel, creds, by_pair=True)
+
+    if ex.name != 'Binance':
+        # Get api orders
+        log.debug(f'{cube} Checking for rogue orders (API)')
+        args = {**creds, **{'type': 'open'}}
+        orders = api_request(cube, 'GET', ex.name, '/orders', args)
+        # Cancel outstanding rogue orders
+        if orders:
+            log.debug(f'{cube} Rogue orders {orders}')
+            rogue = [(order_id, None, None) for order_id in orders
+                     if order_id not in cube.all_orders]
+            cancel_orders_concurrently(cube, ex, rogue, creds)
+            cube.unrecognized_activity = True
+            db_session.add(cube)
+            db_session.commit()
+
+    if ex.name == 'Binance':
+        # Check all possible pairs for currencies with reserved balance
+        ex_pairs = []
+        for bal in cube.balances:
+            if bal.total > bal.available:
+                for ex_pair in pair_index.touching(ex.id, bal.currency_id):
+                    if ex_pair not in ex_pairs:
+                        ex_pairs.append(ex_pair)
+        if ex_pairs:
+            log.debug(f'{cube} Checking for rogue orders (API)')
+        requests = []
+        for ex_pair in ex_pairs:
+            args = {**creds, **{'base': ex_pair.base_currency.symbol,
+                                'quote': ex_pair.quote_currency.symbol,
+                                'type': 'open'}}
+            requests.append(('GET', ex.name, '/orders', args))
+        rogue = []
+        for ex_pair, orders in zip(ex_pairs, api_requests(cube, ex, requests)):
+            if orders:
+                rogue.extend((order_id,
+                              ex_pair.base_currency.symbol,
+                              ex_pair.quote_currency.symbol)
+                             for order_id in orders)
+        if rogue:
+            for order_id, _, _ in rogue:
+                log.info(f'{cube} Canceling order: {order_id} (rogue)')
+            cancel_orders_concurrently(cube, ex, rogue, creds, by_pair=True)
+            cube.unrecognized_activity = True
+            db_session.add(cube)
+            db_session.commit()
+
+
 def set_last(cube):
     for bal in cube.balances:
         # Set last balance to current total
@@ -442,37 +326,54 @@ def set_last(cube):
 
 
 @celery.task(base=SqlAlchemyTask)
-def reconcile_cube(cube_id):
+def reconcile_cube(cube_id, token=None):
     try:
         cube = Cube.query.get(cube_id)
+        if token and not renew(cube_id, token):
+            # Expired while queued (new_orders stops the chain)
+            log.warning(f'{cube} Lease lost (not reconciling)')
+            return
         # Reconcile cube
-        for conn in cube.connections.values():
-            ex = conn.exchange
-            creds = get_api_creds(cube, ex)
-            log.info(f'{cube} Reconciling {ex}')
+        with Heartbeat(cube_id, token):
+            reconcile_connections(cube)
+    except SoftTimeLimitExceeded:
+        release(cube_id, token)
+        ## To do: error handling
+    except Exception:
+        # The chain stops here, free the cube for the next tick
+        release(cube_id, token)
+        raise
+
 
-            # Set last balance to total
-            set_last(cube)
+def reconcile_connections(cube):
+    for conn in cube.connections.values():
+        ex = conn.exchange
+        creds = get_api_creds(cube, ex)
+        log.info(f'{cube} Reconciling {ex}')
 
-            # Get api balances
-            log.debug(f'{cube} Getting balances (API)')
-            bals = api_request(cube, 'GET', ex.name, '/balances', creds)
+        # Set last balance to total
+        set_last(cube)
 
-            if bals:
-                # Reconcile orders
+        # Get api balances
+        log.debug(f'{cube} Getting balances (API)')
+        bals = api_request(cube, 'GET', ex.name, '/balances', creds)
+
+        if bals:
+            # Reconcile orders
+            if USE_ASYNC_API:
+                order_reconciliation_concurrently(cube, ex, creds, bals)
+            else:
                 order_reconciliation(cube, ex, creds, bals)
-                # Reconcile exchange balances with db balances
-                # Covers rogue orders, deposits, etc.
-                log.debug(f'{cube} Reconciling Balances')
-                reconcile_balances(cube, ex, bals)
+            # Reconcile exchange balances with db balances
+            # Covers rogue orders, deposits, etc.
+            log.debug(f'{cube} Reconciling Balances')
+            reconcile_balances(cube, ex, bals)
 
-            update_transactions(cube, creds)
+        update_transactions(cube, creds)
 
-    except SoftTimeLimitExceeded:
-        update_cube_cache(cube_id, False)
-        ## To do: error handling
 
-def rebalance(cube, indiv, comb):
+def rebalance(cube):
+    # Whether the cube's balance targets need a new optimization
     log.debug(f'{cube} Rebalancing')
     r = False
     # Run optimization if needed
@@ -501,135 +402,271 @@ def rebalance(cube, indiv, comb):
                 r = True
         else:
             log.info(f'{cube} Optimization complete')
-    if r:
-        log.info(f'{cube} Running Optimization')
+    return r
+
+
+def optimization_due(cube):
+    if cube.algorithm.name not in ['Centaur'] or not rebalance(cube):
+        return False
+    db_session.add(cube)
+    db_session.commit()
+    return True
+
+
+def optimize(cubes):
+    problems = {}
+    for cube in cubes:
+        if not sanity_check(cube):
+            continue
         try:
-            indiv, comb = regression(cube, indiv, comb)
-            print(indiv)
-            print(comb)
-            if indiv is None:  # just to be safe, should never happen
-                log.info('No valid solution from regression.')
-            return indiv, comb
-        except:
-            log.exception('Exception from regression function')
+            indiv = calc_indiv(cube)
+            comb = calc_comb(cube, indiv)
+        except Exception:
+            log.exception(f'{cube} Unable to value balances')
+            db_session.rollback()
+            continue
+        log.info(f'{cube} Running Optimization')
+        problems[cube] = (indiv, comb)
+    try:
+        results = regression_batch(problems)
+    except:
+        log.exception('Exception from regression function')
+        return
+    for cube in problems:
+        if results[cube.id]['indiv'] is None:
+            log.info(f'{cube} No valid solution from regression.')
+
+
+@celery.task(base=SqlAlchemyTask)
+def optimize_cubes(leases):
+    """ Solver step of new_orders, on the optimizer queue.
+
+    leases is a list of (cube_id, token). The cubes are solved together
+    (see regression_batch), then each goes on to new_orders on its
+    exchange queue with its lease.
+    """
+    held = []
+    for cube_id, token in leases:
+        if token and not renew(cube_id, token):
+            log.warning(f'Cube: {cube_id} Lease lost (not optimizing)')
+        else:
+            held.append((cube_id, token))
+    try:
+        with ExitStack() as stack:
+            beats = [stack.enter_context(Heartbeat(cube_id, token))
+                     for cube_id, token in held]
+            optimize([Cube.query.get(cube_id) for cube_id, _ in held])
+        for (cube_id, token), hb in zip(held, beats):
+            if hb.lost:
+                log.warning(f'Cube: {cube_id} Lease lost (not generating orders)')
+                continue
+            # Orders are generated against the new targets
+            new_orders.delay(cube_id, token, optimized=True)
+    except SoftTimeLimitExceeded:
+        for cube_id, token in held:
+            release(cube_id, token)
+        ## To do: error handling
+    except Exception:
+        for cube_id, token in held:
+            release(cube_id, token)
+        raise
 
 
 @celery.task(base=SqlAlchemyTask)
-def new_orders(cube_id):  
+def new_orders(cube_id, token=None, optimized=False):
     try:
         cube = Cube.query.get(cube_id)
+        if token and not renew(cube_id, token):
+            # Expired during reconcile_cube, another run may hold the cube
+            log.warning(f'{cube} Lease lost (not generating orders)')
+            return
+        if not optimized and optimization_due(cube):
+            # optimize_cubes passes the lease back to new_orders
+            optimize_cubes.delay([(cube_id, token)])
+            return
         log.info(f'{cube} Generating Orders')
-        #### Sanity Check ####
-        if not sanity_check(cube):
-            log.warning(f'{cube} failed sanity check')
-            update_cube_cache(cube_id, False) 
-            return    
-            
-        #### Individual Valuations ####
-        indiv = calc_indiv(cube)
-        log.debug(f'{cube} Individual valuations:\n{indiv}')
-        comb = calc_comb(cube, indiv)
-        log.debug(f'{cube} Combined valuations:\n{comb}')
-
-        # Rebalance cubes
-        if cube.algorithm.name in ['Centaur']:
-            rebalance(cube, indiv, comb)
-
-        if cube.trading_status == 'live':
-            #### Generate Target Allocation Orders ####
-            print(indiv, comb)
-            orders = target_orders(cube, indiv, comb, orders=[])
-            log.debug(f'{cube} Individual Orders:\n{pformat(orders)}')
-            if orders:
-                place_orders.delay(cube_id, orders)
-            else:
-                update_cube_cache(cube_id, False)
-                cube.balanced_at = datetime.utcnow()  
-                db_session.add(cube)
-                db_session.commit()
-                log.debug(f'{cube} No Orders')
-            cube.suspended_at = datetime.utcnow()
-            db_session.add(cube)
-            db_session.commit()
-        update_cube_cache(cube_id, False)
+        with Heartbeat(cube_id, token) as hb:
+            orders = generate_orders(cube)
+        if orders:
+            if hb.lost or (token and not renew(cube_id, token)):
+                # Another run took over the cube
+                log.warning(f'{cube} Lease lost (not placing orders)')
+                return
+            # place_orders releases the lease once the orders are placed
+            place_orders.delay(cube_id, orders, token)
+        else:
+            release(cube_id, token)
+        schedule_cube(cube)
     except SoftTimeLimitExceeded:
-        update_cube_cache(cube_id, False)
+        release(cube_id, token)
         ## To do: error handling
+    except Exception:
+        release(cube_id, token)
+        raise
+
+
+def generate_orders(cube):
+    #### Sanity Check ####
+    if not sanity_check(cube):
+        log.warning(f'{cube} failed sanity check')
+        return []
+
+    #### Individual Valuations ####
+    indiv = calc_indiv(cube)
+    log.debug(f'{cube} Individual valuations:\n{indiv}')
+    comb = calc_comb(cube, indiv)
+    log.debug(f'{cube} Combined valuations:\n{comb}')
+
+    orders = []
+    if cube.trading_status == 'live':
+        #### Generate Target Allocation Orders ####
+        orders = target_orders(cube, indiv, comb, orders=[])
+        log.debug(f'{cube} Individual Orders:\n{pformat(orders)}')
+        if not orders:
+            cube.balanced_at = datetime.utcnow()  
+            db_session.add(cube)
+            db_session.commit()
+            log.debug(f'{cube} No Orders')
+        cube.suspended_at = datetime.utcnow()
+        db_session.add(cube)
+        db_session.commit()
+    return orders
+
 
 @celery.task(base=SqlAlchemyTask)
 def process_cube(cube_id):
+    token = None
     try:
         cube = Cube.query.get(cube_id)
-        cache = CubeCache.query.filter_by(cube_id=cube_id).first()
         log.debug(f'{cube} Processing')
 
-        if cache and cache.processing == True:
-            log.debug(f'{cube} already in cache')
+        # Held until the end of the chain (or LEASE_TTL after a crash)
+        token = acquire(cube_id)
+        if not token:
+            log.debug(f'{cube} already processing')
             return
-        else:
-            log.debug(f'{cube} adding to cache')
-            # Add to CubeCache
-            update_cube_cache(cube_id, True)     
 
         log.debug(f'{cube} reconcile/generate new orders')
         #### Reconcile Cube/Generate New Orders ####
-        chain(reconcile_cube.si(cube_id), new_orders.si(cube_id))()
+        chain(reconcile_cube.si(cube_id, token), new_orders.si(cube_id, token))()
 
     except SoftTimeLimitExceeded:
-        update_cube_cache(cube_id, False)
+        release(cube_id, token)
 
-def run_trader():
-    # Find active Cubes
-    active = and_(
-        Cube.closed_at == None,
-        Cube.trading_status == 'live',
-        Cube.algorithm.has(Algorithm.name.in_(['Centaur'])),
-        not_(Cube.connections.any(Connection.failed_at != None)),
-        Cube.connections.any()    
-        )
+@celery.task(base=SqlAlchemyTask)
+def process_exchange_batch(ex_id, cube_ids):
+    """ Reconcile and generate orders for several cubes on one exchange.
+
+    The ExPairs, market metadata and midprices of the exchange are loaded
+    once and shared by every cube in the batch. A failing cube is logged
+    and released without affecting the others. Cubes due for optimization
+    are sent to the optimizer queue in one task. Cubes not started within
+    EXCHANGE_BATCH_BUDGET seconds are rescheduled.
+    """
+    ex = Exchange.query.get(ex_id)
+    log.info(f'{ex} Processing {len(cube_ids)} cubes')
+    pair_index.active(ex.id)
+    load_markets(ex.name)
+    start = time()
+    with price_snapshot():
+        # Heartbeats of the cubes waiting for the optimizer
+        due, beats = [], ExitStack()
+        try:
+            for i, cube_id in enumerate(cube_ids):
+                if time() - start > EXCHANGE_BATCH_BUDGET:
+                    log.info(f'{ex} Batch out of time, rescheduling {len(cube_ids) - i} cubes')
+                    schedule({cube_id: datetime.utcnow() for cube_id in cube_ids[i:]})
+                    break
+                token = acquire(cube_id)
+                if not token:
+                    log.debug(f'Cube: {cube_id} already processing')
+                    continue
+                try:
+                    cube = Cube.query.get(cube_id)
+                    with Heartbeat(cube_id, token) as hb:
+                        reconcile_connections(cube)
+                        if optimization_due(cube):
+                            due.append((cube_id, token,
+                                        beats.enter_context(Heartbeat(cube_id, token))))
+                            continue
+                        log.info(f'{cube} Generating Orders')
+                        orders = generate_orders(cube)
+                    if orders and (hb.lost or not renew(cube_id, token)):
+                        # Another run took over the cube
+                        log.warning(f'{cube} Lease lost (not placing orders)')
+                    elif orders:
+                        # place_orders releases the lease once the orders are placed
+                        place_orders.delay(cube_id, orders, token)
+                    else:
+                        release(cube_id, token)
+                    schedule_cube(cube)
+                except SoftTimeLimitExceeded:
+                    release(cube_id, token)
+                    schedule({cube_id: datetime.utcnow() for cube_id in cube_ids[i:]})
+                    return
+                except Exception:
+                    log.exception(f'Cube: {cube_id} Batch processing failed')
+                    db_session.rollback()
+                    release(cube_id, token)
+        finally:
+            beats.close()
+            for cube_id, _, hb in due:
+                if hb.lost:
+                    log.warning(f'Cube: {cube_id} Lease lost (not optimizing)')
+            # Solved together on the optimizer queue, which continues with
+            # new_orders (and keeps the leases)
+            due = [(cube_id, token) for cube_id, token, hb in due if not hb.lost]
+            if due:
+                optimize_cubes.delay(due)
+
+
+def dispatch_cubes(cubes):
+    # Cubes on a single exchange are batched, the rest run one by one
+    tasks, batches = [], {}
+    for cube in cubes:
+        exs = {conn.exchange for conn in cube.connections.values()}
+        if EXCHANGE_BATCH_SIZE > 1 and len(exs) == 1:
+            batches.setdefault(exs.pop(), []).append(cube.id)
+        else:
+            tasks.append(process_cube.si(cube.id).set(queue=cube_queue(cube)))
+    for ex, cube_ids in batches.items():
+        for i in range(0, len(cube_ids), EXCHANGE_BATCH_SIZE):
+            batch = cube_ids[i:i + EXCHANGE_BATCH_SIZE]
+            if len(batch) == 1:
+                # Nothing to share
+                task = process_cube.si(batch[0])
+            else:
+                task = process_exchange_batch.si(ex.id, batch)
+            tasks.append(task.set(queue=exchange_queue(ex.name)))
+    if tasks:
+        group(tasks).apply_async()
 
+
+def run_trader():
+    # Dispatch only the cubes that are due (see utils.schedule)
     try:
-        cubes = Cube.query.filter(
-            active,
-            ).order_by(
-            Cube.suspended_at
-            ).all()
-
-        log.debug(cubes)
-        for cube in cubes:
-            try:   
-                log.debug(f'{cube} Starting')
-                cache = CubeCache.query.filter_by(cube_id=cube.id).first()
-                if cache and cache.processing == True:
-                    if (cache.updated_at and
-                        (cube.updated_at +
-                        timedelta(hours=1)) <= datetime.utcnow()):
-                        update_cube_cache(cube.id, False)  
-                        log.debug(f'{cube} 1 hours past last update (processing)')
-                        process_cube.delay(cube.id)
-                    else:
-                        log.debug(f'{cube} Already processing (skipping)')
-                        continue
-                elif not cube.balanced_at:
-                    log.debug(f'{cube} Never balanced (processing)')
-                    process_cube.delay(cube.id)
-                elif (cube.reallocated_at and
-                    (cube.reallocated_at >= cube.balanced_at)):
-                    log.debug(f'{cube} Recently reallocated (processing)')
-                    process_cube.delay(cube.id)
-                elif cube.orders:
-                    log.debug(f'{cube} Open orders (processing)') 
-                    process_cube.delay(cube.id)                   
-                elif (cube.suspended_at and
-                    (cube.suspended_at + timedelta(minutes=10)) > datetime.utcnow()):
-                    log.debug(f'{cube} less than 10 minutes since last update (skipping)')
-                    continue
-                else:
-                    log.debug(f'{cube} Scheduled run (processing)')
-                    process_cube.delay(cube.id)
-                
-            except Exception as e:
-                log.exception('Unhandled exception')
+        sync_schedule()
+        cube_ids = pop_due()
+        if not cube_ids:
+            return
+        cubes = {cube.id: cube for cube in
+                 Cube.query.filter(Cube.id.in_(cube_ids), active_filter())}
+        busy = leased(cube_ids)
+        # Retried after the lease would have expired; new_orders
+        # reschedules on completion
+        retry = datetime.utcnow() + timedelta(seconds=LEASE_TTL)
+        dispatch = []
+        for cube_id in cube_ids:
+            cube = cubes.get(cube_id)
+            if not cube:
+                continue
+            if cube_id in busy:
+                log.debug(f'{cube} Already processing (skipping)')
+                continue
+            log.debug(f'{cube} Due (processing)')
+            dispatch.append(cube_id)
+        schedule({cube_id: retry for cube_id in cube_ids if cube_id in cubes})
+        dispatch_cubes([cubes[cube_id] for cube_id in dispatch])
 
     except Exception as e:
         log.exception('Main thread exception')
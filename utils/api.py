@@ -1,7 +1,13 @@
 from decimal import Decimal as dec
+from random import uniform
+from time import sleep
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
 from database import *
+from .cache import cached_price
+from .limiter import acquire
 
 log = logging.getLogger(__name__)
 
@@ -9,6 +15,27 @@ _exapi_url = os.getenv('EXAPI_URL')
 
 GRACE_TIME = 5 # Seconds to sleep on exception
 API_RETRIES = 3  # Times to retry query before giving up
+POOL_SIZE = int(os.getenv('EXAPI_POOL_SIZE', 10))  # Keep-alive connections per exchange
+CONNECT_TIMEOUT = 3.05  # Seconds
+READ_TIMEOUT = 30  # Seconds (default)
+# Read timeouts for slow endpoints (history queries can take a while)
+ENDPOINT_TIMEOUTS = {
+    '/midprice': 10,
+    '/details': 10,
+    '/trades': 60,
+    '/transactions': 60,
+}
+RETRY_STATUS = [429, 503]
+# Safe to resend whatever happened to the first attempt. Anything else
+# (placing or canceling an order) may already have been accepted, so is
+# only resent if it never reached the exchange or was rate limited.
+IDEMPOTENT_METHODS = ['GET']
+UNSENT_RETRY_STATUS = [429]
+# Some exchanges throttle with 403; only these in the body mean the key was refused
+AUTH_ERRORS = ['authentication', 'permission', 'api key', 'apikey', 'signature']
+
+# One pooled session per exchange base URL
+_sessions = {}
 
 
 def delete_order(cube, order_id):
@@ -21,24 +48,111 @@ def delete_order(cube, order_id):
         pass
 
 
+def get_session(exchange):
+    base_url = f'{_exapi_url}/{exchange}'
+    session = _sessions.get(base_url)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _sessions[base_url] = session
+    return session
+
+
+def get_timeout(endpoint):
+    for prefix, read_timeout in ENDPOINT_TIMEOUTS.items():
+        if endpoint.startswith(prefix):
+            return CONNECT_TIMEOUT, read_timeout
+    return CONNECT_TIMEOUT, READ_TIMEOUT
+
+
+def backoff(attempt):
+    # Exponential backoff with jitter so workers don't retry in lockstep
+    return GRACE_TIME * 2 ** attempt * uniform(0.5, 1.5)
+
+
+def not_sent(e):
+    # True if the request failed before reaching the exchange
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    cause = e.args[0] if e.args else None
+    return isinstance(getattr(cause, 'reason', cause), NewConnectionError)
+
+
+def auth_error(body):
+    body = str(body or '').lower()
+    return any(error in body for error in AUTH_ERRORS)
+
+
+def throttled(status_code, body):
+    # Rejected by the exchange's rate limit (so never accepted)
+    return status_code == 429 or (status_code == 403 and not auth_error(body))
+
+
+def send_request(request_type, exchange, endpoint, params, limit=True,
+                 retries=API_RETRIES):
+    """ Send one EXAPI request, retrying throttling and connection failures.
+
+    Non-idempotent requests are not resent once they may have reached the
+    exchange: the timeout/error is raised (or the response returned) so the
+    caller treats the outcome as unknown and reconciliation settles it.
+    """
+    session = get_session(exchange)
+    url = f'{_exapi_url}/{exchange}{endpoint}'
+    timeout = get_timeout(endpoint)
+    idempotent = request_type in IDEMPOTENT_METHODS
+    retry_status = RETRY_STATUS if idempotent else UNSENT_RETRY_STATUS
+    for attempt in range(retries):
+        last_try = attempt == retries - 1
+        if limit:
+            # Wait for a token from the shared per-exchange bucket
+            acquire(exchange, endpoint, params)
+        try:
+            r = session.request(request_type, url, params=params, timeout=timeout)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            if last_try or not (idempotent or not_sent(e)):
+                raise
+            log.warning(f'{exchange} {endpoint} {e} (retrying)')
+        else:
+            retry = r.status_code in retry_status or throttled(r.status_code, r.text)
+            if not retry or last_try:
+                return r
+            log.warning(f'{exchange} {endpoint} {r.status_code} (retrying)')
+        sleep(backoff(attempt))
+
+
 def api_request(cube, request_type, exchange, endpoint, params):
     ex = Exchange.query.filter_by(name=exchange).one()
-    url = f'{_exapi_url}/{exchange}{endpoint}'
-    r = requests.request(request_type, url, params=params)
+    try:
+        r = send_request(request_type, exchange, endpoint, params)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout) as e:
+        log.warning(f'{ex} {cube} {endpoint} {e}')
+        return None
     log.debug(r.status_code)
-    if r.status_code == 200:
-        json_content = r.json()
-        return json_content
-    if r.status_code == 400:
+    content = r.json() if r.status_code == 200 else r.text
+    return handle_response(cube, ex, r.status_code, content)
+
+
+def handle_response(cube, ex, status_code, content):
+    # content is the decoded JSON of a 200, otherwise the body text
+    if status_code == 200:
+        return content
+    if status_code == 400:
         return 'InvalidOrder'
-    if r.status_code == 503:
+    if status_code == 503:
         return None 
-    if r.status_code == 401: 
+    if status_code == 401: 
         fail_connection(cube, ex)  
         return None    
-    if r.status_code == 403: 
-        fail_connection(cube, ex)  
-        return None                 
+    if status_code == 403:
+        if auth_error(content):
+            fail_connection(cube, ex)
+        else:
+            log.warning(f'{ex} {cube} Throttled (403)')
+        return None
 
 
 def fail_connection(cube, ex):
@@ -68,12 +182,17 @@ def get_api_creds(cube, exchange):
 
 
 def get_price(exchange, base, quote):
-    url = f'{_exapi_url}/{exchange}/midprice'
+    # Shared across workers, see utils.cache
+    return cached_price(exchange, base, quote,
+                        lambda: fetch_price(exchange, base, quote))
+
+
+def fetch_price(exchange, base, quote):
     params = {
         'base': base,
         'quote': quote
     }
-    r = requests.get(url, params=params)
+    r = send_request('GET', exchange, '/midprice', params)
     if r.status_code == 200:
         price = r.json()
         return dec(price['price_str'])
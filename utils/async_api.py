@@ -0,0 +1,151 @@
+import asyncio
+import atexit
+import aiohttp
+
+from database import *
+from .api import (_exapi_url, API_RETRIES, RETRY_STATUS, POOL_SIZE,
+                  IDEMPOTENT_METHODS, UNSENT_RETRY_STATUS,
+                  get_timeout, backoff, handle_response, throttled)
+from .limiter import acquire_async
+
+log = logging.getLogger(__name__)
+
+USE_ASYNC_API = os.getenv('EXAPI_ASYNC', 'true').lower() == 'true'
+CONCURRENCY = int(os.getenv('EXAPI_CONCURRENCY', 5))  # Requests in flight per exchange
+# Failures where the request never reached the exchange
+NOT_SENT = (aiohttp.ClientConnectorError,) + tuple(
+    e for e in [getattr(aiohttp, 'ConnectionTimeoutError', None)] if e)
+
+# One event loop and client session per worker process (see get_client)
+_loop = None
+_client = None
+_pid = None
+
+
+def encode_params(params):
+    # Match requests: drop None values and send everything else as str
+    if not params:
+        return None
+    return {k: v if isinstance(v, str) else str(v)
+            for k, v in params.items() if v is not None}
+
+
+class AsyncClient:
+    """ Asyncio counterpart of api_request.
+
+    Only talks HTTP: responses come back as (status_code, content) and are
+    passed through handle_response by the caller, so all database work stays
+    sequential on the calling thread.
+    """
+
+    def __init__(self, concurrency=CONCURRENCY):
+        self.concurrency = concurrency
+        self._semaphores = {}
+        self._session = None
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit_per_host=POOL_SIZE)
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    def semaphore(self, exchange):
+        if exchange not in self._semaphores:
+            self._semaphores[exchange] = asyncio.Semaphore(self.concurrency)
+        return self._semaphores[exchange]
+
+    async def send(self, request_type, exchange, endpoint, params):
+        # Same retry rules as api.send_request: requests that may have been
+        # accepted (POST/DELETE) are only resent if they were never sent
+        url = f'{_exapi_url}/{exchange}{endpoint}'
+        connect, read = get_timeout(endpoint)
+        timeout = aiohttp.ClientTimeout(connect=connect, sock_read=read)
+        params = encode_params(params)
+        idempotent = request_type in IDEMPOTENT_METHODS
+        retry_status = RETRY_STATUS if idempotent else UNSENT_RETRY_STATUS
+        for attempt in range(API_RETRIES):
+            last_try = attempt == API_RETRIES - 1
+            try:
+                async with self.semaphore(exchange):
+                    await acquire_async(exchange, endpoint, params)
+                    async with self._session.request(
+                            request_type, url, params=params,
+                            timeout=timeout) as r:
+                        status = r.status
+                        if status == 200:
+                            content = await r.json(content_type=None)
+                        else:
+                            content = await r.text()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if last_try or not (idempotent or isinstance(e, NOT_SENT)):
+                    # Unknown outcome, left to reconciliation
+                    log.warning(f'{exchange} {endpoint} {e!r}')
+                    return None, None
+                log.warning(f'{exchange} {endpoint} {e!r} (retrying)')
+            else:
+                retry = status in retry_status or throttled(status, content)
+                if not retry or last_try:
+                    return status, content
+                log.warning(f'{exchange} {endpoint} {status} (retrying)')
+            await asyncio.sleep(backoff(attempt))
+
+    async def gather(self, requests):
+        # requests: iterable of (request_type, exchange, endpoint, params)
+        return await asyncio.gather(*[self.send(*req) for req in requests])
+
+
+def get_loop():
+    global _loop, _client, _pid
+    if _pid != os.getpid() or _loop is None or _loop.is_closed():
+        # First use, or a forked worker (the parent's loop is not usable)
+        _loop, _client, _pid = asyncio.new_event_loop(), None, os.getpid()
+    return _loop
+
+
+def run(coro):
+    return get_loop().run_until_complete(coro)
+
+
+def get_client():
+    """ Client shared by every call in this process, so connections are reused.
+    """
+    global _client
+    loop = get_loop()
+    if _client is None:
+        client = AsyncClient()
+        loop.run_until_complete(client.open())
+        _client = client
+    return _client
+
+
+@atexit.register
+def close_client():
+    global _client
+    if _client is not None and _pid == os.getpid() and not _loop.is_closed():
+        _loop.run_until_complete(_client.__aexit__())
+    _client = None
+
+
+def api_requests(cube, ex, requests):
+    """ Send independent requests to one exchange concurrently.
+
+    Results are in request order and have the same values api_request
+    would have returned for each.
+    """
+    requests = list(requests)
+    if not requests:
+        return []
+
+    results = []
+    for status, content in run(get_client().gather(requests)):
+        if status is None:
+            # Connection failure
+            results.append(None)
+        else:
+            results.append(handle_response(cube, ex, status, content))
+    return results
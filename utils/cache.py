@@ -0,0 +1,129 @@
+from contextlib import contextmanager
+from decimal import Decimal as dec
+from redis.exceptions import RedisError
+
+from database import *
+# Replacing datetime.time (Do not move)
+from time import time, sleep
+from .store import get_redis
+
+log = logging.getLogger(__name__)
+
+PRICE_TTL = int(os.getenv('PRICE_TTL', 60))  # Seconds a midprice is fresh
+PRICE_STALE = int(os.getenv('PRICE_STALE', 300))  # Seconds a stale midprice is served while refreshing
+REFRESH_LOCK = 10  # Seconds one worker may spend refreshing a key
+REFRESH_WAIT = 2  # Seconds to wait for another worker's fetch of a missing key
+STATS_KEY = 'midprice:stats'
+
+_snapshot = None  # key -> (ts, price) while a price_snapshot() is open
+
+
+def _count(r, field):
+    try:
+        r.hincrby(STATS_KEY, field, 1)
+    except RedisError:
+        pass
+
+
+def _store(r, key, price):
+    pipe = r.pipeline()
+    pipe.hmset(key, {'price': str(price), 'ts': time()})
+    pipe.expire(key, int(PRICE_TTL + PRICE_STALE))
+    pipe.execute()
+
+
+def _refresh(r, key, fetch):
+    price = fetch()
+    try:
+        _store(r, key, price)
+    except RedisError as e:
+        log.warning(f'Unable to cache {key} ({e})')
+    return price
+
+
+@contextmanager
+def price_snapshot():
+    """ Reuse midprices in this process for the duration of the block.
+
+    Used by exchange batches, where every cube prices the same pairs.
+    Entries are only reused while fresh (PRICE_TTL).
+    """
+    global _snapshot
+    _snapshot = {}
+    try:
+        yield _snapshot
+    finally:
+        _snapshot = None
+
+
+def cached_price(exchange, base, quote, fetch):
+    if _snapshot is None:
+        return shared_price(exchange, base, quote, fetch)
+    key = (exchange, base, quote)
+    if key in _snapshot and time() - _snapshot[key][0] < PRICE_TTL:
+        return _snapshot[key][1]
+    price = shared_price(exchange, base, quote, fetch)
+    _snapshot[key] = (time(), price)
+    return price
+
+
+def shared_price(exchange, base, quote, fetch):
+    """ Midprice from the shared cache, calling fetch() on a miss.
+
+    Fresh entries are returned directly. Once stale, exactly one worker
+    (the one holding the refresh lock) fetches a new price while the others
+    keep serving the stale one. On a cold key the others briefly wait for
+    that fetch instead of all hitting EXAPI.
+    """
+    key = f'midprice:{exchange}:{base}:{quote}'
+    lock = f'{key}:lock'
+    try:
+        r = get_redis()
+        price, ts = r.hmget(key, 'price', 'ts')
+    except RedisError as e:
+        log.warning(f'Price cache unavailable ({e})')
+        return fetch()
+
+    if price is not None:
+        if time() - float(ts) < PRICE_TTL:
+            _count(r, 'hits')
+            return dec(price.decode())
+        if not r.set(lock, 1, nx=True, ex=REFRESH_LOCK):
+            # Another worker is refreshing
+            _count(r, 'stale')
+            return dec(price.decode())
+        _count(r, 'refreshes')
+        try:
+            return _refresh(r, key, fetch)
+        except Exception as e:
+            log.warning(f'{key} refresh failed, serving stale price ({e})')
+            return dec(price.decode())
+        finally:
+            r.delete(lock)
+
+    _count(r, 'misses')
+    if not r.set(lock, 1, nx=True, ex=REFRESH_LOCK):
+        deadline = time() + REFRESH_WAIT
+        while time() < deadline:
+            sleep(0.05)
+            price = r.hget(key, 'price')
+            if price is not None:
+                return dec(price.decode())
+        # Refreshing worker is too slow, fetch anyway
+        return _refresh(r, key, fetch)
+    try:
+        return _refresh(r, key, fetch)
+    finally:
+        r.delete(lock)
+
+
+def price_cache_stats():
+    # Counters since the stats were last reset
+    stats = {'hits': 0, 'misses': 0, 'stale': 0, 'refreshes': 0}
+    for field, count in get_redis().hgetall(STATS_KEY).items():
+        stats[field.decode()] = int(count)
+    return stats
+
+
+def reset_price_cache_stats():
+    get_redis().delete(STATS_KEY)
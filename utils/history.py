@@ -0,0 +1,397 @@
+import numpy as np
+from redis.exceptions import RedisError
+from sqlalchemy import Index
+
+from database import *
+# Replacing datetime.time (Do not move)
+from time import time
+from .api import api_request
+from .async_api import USE_ASYNC_API, api_requests
+from .pairs import pair_index
+from .store import get_redis
+
+log = logging.getLogger(__name__)
+
+INSERT_BATCH = 500  # Rows per multi-row INSERT
+DAY = 24 * 60 * 60 * 1000  # Milliseconds
+SCAN_STEP = 10 * DAY  # First window probed after data
+MAX_SCAN_STEP = int(os.getenv('HISTORY_MAX_SCAN_DAYS', 640)) * DAY
+TRANSFER_TYPES = {'deposit': 'deposit', 'withdrawal': 'withdrawal', 'withdraw': 'withdrawal'}
+# Transaction types recorded by each stream
+STREAM_TYPES = {'trades': ['buy', 'sell'], 'transactions': ['deposit', 'withdrawal']}
+
+# One row per tx_id, however many imports of a cube overlap. Created with
+# the tables; add it to an existing database with python -m utils.history
+TX_INDEX = Index('uq_transactions_cube_ex_tx', Transaction.__table__.c.cube_id,
+                 Transaction.__table__.c.exchange_id, Transaction.__table__.c.tx_id,
+                 unique=True)
+
+
+def cursor_key(cube, ex, stream, pair=None):
+    return f'history:{cube.id}:{ex.id}:{stream}:{pair or "*"}'
+
+
+def quiet_key(cube, ex):
+    # Hash of stream:pair -> T, with no activity on the stream before T
+    return f'history:quiet:{cube.id}:{ex.id}'
+
+
+def get_quiet(cube, ex, stream, pair=None):
+    try:
+        quiet = get_redis().hget(quiet_key(cube, ex), f'{stream}:{pair or "*"}')
+    except RedisError as e:
+        log.warning(f'{cube} Quiet marker unavailable ({e})')
+        return None
+    return int(quiet) if quiet else None
+
+
+def set_quiet(cube, ex, stream, until, pair=None):
+    try:
+        get_redis().hset(quiet_key(cube, ex), f'{stream}:{pair or "*"}', int(until))
+    except RedisError as e:
+        log.warning(f'{cube} Unable to save quiet marker ({e})')
+
+
+def start_cursor(cube, ex, stream, pair=None):
+    """ Timestamp (ms) to resume stream from.
+
+    The stored cursor, else just after the newest recorded transaction of
+    the stream, else the end of its quiet range, else the account start.
+    """
+    try:
+        since = get_redis().get(cursor_key(cube, ex, stream, pair))
+    except RedisError as e:
+        log.warning(f'{cube} History cursor unavailable ({e})')
+        since = None
+    if since:
+        return int(since)
+    db_tx = Transaction.query.filter(
+        Transaction.cube_id == cube.id,
+        Transaction.exchange_id == ex.id,
+        Transaction.type.in_(STREAM_TYPES[stream]),
+        Transaction.timestamp != None,
+    )
+    if pair:
+        base, quote = pair.split('/')
+        db_tx = db_tx.filter_by(base_symbol=base, quote_symbol=quote)
+    db_tx = db_tx.order_by(Transaction.id.desc()).first()
+    if db_tx:
+        log.debug(f'{cube} {stream} {pair or ""} exist, updating from {db_tx.timestamp}')
+        return int(float(db_tx.timestamp)) + 1
+    quiet = get_quiet(cube, ex, stream, pair)
+    if quiet:
+        log.debug(f'{cube} {stream} {pair or ""} quiet until {quiet}')
+        return quiet
+    log.debug(f'{cube} {stream} {pair or ""} do not exist, updating from account start')
+    return account_start(cube)
+
+
+def account_start(cube):
+    return int(datetime.timestamp(cube.created_at) * 1000)  # Convert to milliseconds
+
+
+def save_cursor(cube, ex, stream, since, pair=None):
+    try:
+        get_redis().set(cursor_key(cube, ex, stream, pair), int(since))
+    except RedisError as e:
+        log.warning(f'{cube} Unable to save history cursor ({e})')
+
+
+class Scan:
+    """ Position of one history stream.
+
+    Each request is bounded by until. An empty answer means [since, until)
+    is empty: the window doubles (up to MAX_SCAN_STEP) across consecutive
+    empty ranges and drops back to SCAN_STEP once data is found.
+    """
+
+    def __init__(self, since, now=None):
+        self.since = since
+        self.now = now or int(time() * 1000)
+        self.step = SCAN_STEP
+        self.done = since >= self.now
+
+    def bounds(self):
+        return {'since': self.since, 'until': min(self.since + self.step, self.now)}
+
+    def advance(self, content):
+        # Move past the answer to bounds(), returning its page (None if empty)
+        page = pd.read_json(content)
+        if page.empty:
+            self.since = min(self.since + self.step, self.now)
+            self.step = min(self.step * 2, MAX_SCAN_STEP)
+            page = None
+        else:
+            self.step = SCAN_STEP
+            page['timestamp'] = page.timestamp.values.astype('datetime64[ms]').astype(np.int64)
+            next_since = int(page.timestamp.max()) + 1
+            if next_since <= self.since:
+                # Exchange ignored since
+                self.done = True
+            self.since = max(self.since, next_since)
+        self.done = self.done or self.since >= self.now
+        return page
+
+
+def fetch_pages(cube, ex, url, args, since):
+    """ Pages of url from since until now, as (page, next since).
+
+    page is None when the range up to next since is empty.
+    """
+    scan = Scan(since)
+    while not scan.done:
+        content = api_request(cube, 'GET', ex.name, url, {**args, **scan.bounds()})
+        if not content:
+            return
+        page = scan.advance(content)
+        yield page, scan.since
+
+
+def import_stream(cube, ex, stream, url, args, to_rows, pair=None):
+    """ Import a history stream one page at a time.
+
+    Each page is written (to_rows(ex, page) -> Transaction rows) before the
+    next is fetched, and the cursor is saved after every page, so an
+    interrupted import resumes where it stopped. While nothing has been
+    found since the account start, the stream's quiet marker follows the
+    scan so later runs never rescan the empty range. Returns rows written.
+    """
+    since = start_cursor(cube, ex, stream, pair)
+    quiet = since in [account_start(cube), get_quiet(cube, ex, stream, pair)]
+    log.debug(f'{cube} Get {stream} {pair or ""} from {since}')
+    written = 0
+    for page, since in fetch_pages(cube, ex, url, args, since):
+        if page is not None:
+            if quiet:
+                set_quiet(cube, ex, stream, page.timestamp.min(), pair)
+                quiet = False
+            written += write_transactions(cube, ex, to_rows(ex, page))
+        elif quiet:
+            set_quiet(cube, ex, stream, since, pair)
+        save_cursor(cube, ex, stream, since, pair)
+    return written
+
+
+def import_pair_streams(cube, ex, stream, url, args, pairs, to_rows):
+    """ import_stream for many pairs of one exchange at once.
+
+    pairs maps 'BASE/QUOTE' -> request params of that pair. Every round sends
+    the next request of each unfinished pair concurrently (within the
+    exchange's rate limits), then writes the round's pages merged in
+    timestamp order before saving the cursors. Returns rows written.
+    """
+    if not USE_ASYNC_API:
+        return sum(import_stream(cube, ex, stream, url, {**args, **params}, to_rows, pair=pair)
+                   for pair, params in pairs.items())
+    scans, quiet = {}, {}
+    for pair in pairs:
+        since = start_cursor(cube, ex, stream, pair)
+        quiet[pair] = since in [account_start(cube), get_quiet(cube, ex, stream, pair)]
+        scans[pair] = Scan(since)
+    written = 0
+    while True:
+        active = [pair for pair, scan in scans.items() if not scan.done]
+        if not active:
+            return written
+        log.debug(f'{cube} Get {stream} for {len(active)} pairs')
+        requests = [('GET', ex.name, url, {**args, **pairs[pair], **scans[pair].bounds()})
+                    for pair in active]
+        pages = []
+        for pair, content in zip(active, api_requests(cube, ex, requests)):
+            scan = scans[pair]
+            if not content:
+                scan.done = True
+                continue
+            page = scan.advance(content)
+            if page is not None:
+                if quiet[pair]:
+                    set_quiet(cube, ex, stream, page.timestamp.min(), pair)
+                    quiet[pair] = False
+                pages.append(page)
+            elif quiet[pair]:
+                set_quiet(cube, ex, stream, scan.since, pair)
+        if pages:
+            page = pd.concat(pages).sort_values('timestamp', kind='mergesort')
+            written += write_transactions(cube, ex, to_rows(ex, page))
+        for pair in active:
+            save_cursor(cube, ex, stream, scans[pair].since, pair)
+
+
+def traded_pairs(cube, ex):
+    """ Pairs of ex touching the cube's balances that it may have traded.
+
+    A trade needs one side of the pair to have been held, so pairs are
+    skipped unless a side has a balance or appears in recorded transactions
+    (deposits/withdrawals are imported before trades).
+    """
+    held = set(b.currency_id for b in cube.balances
+               if b.exchange_id == ex.id and b.total)
+    symbols = set()
+    for base, quote in db_session.query(
+            Transaction.base_symbol, Transaction.quote_symbol).filter(
+            Transaction.cube_id == cube.id,
+            Transaction.exchange_id == ex.id).distinct():
+        symbols.update([base, quote])
+    ex_pairs = {}
+    for bal in cube.balances:
+        for ex_pair in pair_index.touching(ex.id, bal.currency_id):
+            ex_pairs[ex_pair.id] = ex_pair
+    return [ep for ep in ex_pairs.values()
+            if ep.base_currency_id in held or ep.quote_currency_id in held
+            or ep.base_symbol in symbols or ep.quote_symbol in symbols]
+
+
+def write_transactions(cube, ex, rows):
+    """ Insert Transaction rows in one database transaction.
+
+    rows is a DataFrame with Transaction column names. Rows whose tx_id is
+    already recorded for the cube on ex are skipped by TX_INDEX (INSERT
+    IGNORE), so re-imports, including concurrent ones, are no-ops. Returns
+    the number of rows inserted.
+    """
+    if rows.empty:
+        return 0
+    rows = rows.drop_duplicates('tx_id')
+    rows = rows.assign(cube_id=cube.id, exchange_id=ex.id, user_id=cube.user_id)
+    # Plain python values for the DB driver
+    records = rows.astype(object).where(rows.notnull(), None).to_dict('records')
+    insert = Transaction.__table__.insert().prefix_with('IGNORE', dialect='mysql')
+    written = 0
+    try:
+        for i in range(0, len(records), INSERT_BATCH):
+            written += db_session.execute(insert.values(records[i:i + INSERT_BATCH])).rowcount
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    log.debug(f'{cube} Wrote {written} transactions')
+    return written
+
+
+def add_tx_index():
+    # Drop duplicates left by overlapping imports (keeping the first row), then index
+    db_session.execute("""
+        DELETE t1 FROM transactions t1 JOIN transactions t2
+        ON t1.cube_id = t2.cube_id AND t1.exchange_id = t2.exchange_id
+        AND t1.tx_id = t2.tx_id AND t1.id > t2.id""")
+    db_session.commit()
+    TX_INDEX.create(db_session.get_bind())
+
+
+def normalize_trades(trades):
+    # Adjustments to dataframe to match table structure
+    fee = trades['fee'].apply(pd.Series)
+    try:
+        fee = fee.drop(['type'], axis=1)
+    except:
+        pass
+    try:
+        fee = fee.rename(index=str, columns={'rate': 'fee_rate', 'cost': 'fee_amount', 'currency': 'fee_currency'})
+    except:
+        pass
+    trades = pd.concat([trades, fee], axis=1)
+    trades = trades.rename(index=str, columns={'id': 'tx_id', 'order': 'order_id', 'amount': 'base_amount', 'cost': 'quote_amount'})
+    symbol = trades['symbol'].str.split('/', n=1, expand=True)
+    trades['base_symbol'] = symbol[0]
+    trades['quote_symbol'] = symbol[1]
+    trades['trade_type'] = trades['type']
+    trades['type'] = trades['side']
+    trades.drop(['side', 'symbol', 'fee'], axis=1, inplace=True)
+    _, i = np.unique(trades.columns, return_index=True)
+    trades = trades.iloc[:, i]
+    return trades.fillna(value=0)
+
+
+def normalize_transfers(trans):
+    # Adjustments to dataframe to match table structure
+    if trans['fee'].any():
+        fee = trans['fee'].apply(pd.Series)
+        try:
+            fee = fee.rename(index=str, columns={'rate': 'fee_rate', 'cost': 'fee_amount'})
+            trans = pd.concat([trans, fee], axis=1)
+        except:
+            log.debug('missing transaction fee information, skipping...')
+        trans.drop(['fee'], axis=1, inplace=True)
+    trans = trans.rename(index=str, columns={'id': 'tx_id', 'txid': 'order_id'})
+    trans.drop(['status', 'updated'], axis=1, inplace=True)
+    _, i = np.unique(trans.columns, return_index=True)
+    trans = trans.iloc[:, i]
+    return trans.fillna(value=0)
+
+
+def trade_rows(ex, trades):
+    """ Transaction rows for a /trades page, on known pairs only.
+    """
+    trades = normalize_trades(trades)
+    known = pair_index.symbols(ex.id)
+    pairs = pd.Series(list(zip(trades.base_symbol, trades.quote_symbol)), index=trades.index)
+    trades = trades[pairs.isin(known) & (trades.base_amount != 0)]
+    buy = (trades.type == 'buy').values
+    sell = (trades.type == 'sell').values
+    rows = pd.DataFrame({
+        'tx_id': trades.tx_id.astype(str),
+        'datetime': trades.index.str[0:19],
+        'timestamp': trades.timestamp.astype(np.int64),
+        'order_id': trades.order_id,
+        'type': trades.type,
+        'trade_type': trades.trade_type.where(trades.trade_type != 0, None),
+        'price': trades.price,
+        'base_symbol': trades.base_symbol,
+        'quote_symbol': trades.quote_symbol,
+        'base_amount': np.select([buy, sell], [trades.base_amount, -trades.base_amount], np.nan),
+        'quote_amount': np.select([buy, sell], [-trades.quote_amount, trades.quote_amount], np.nan),
+    }, index=trades.index)
+    for col in ['fee_rate', 'fee_amount', 'fee_currency']:
+        if col in trades.columns:
+            rows[col] = trades[col]
+    return rows.reset_index(drop=True)
+
+
+def transfer_rows(ex, trans):
+    """ Transaction rows for the deposits and withdrawals of a /transactions page.
+
+    Amounts are booked as base of the first pair trading the currency as
+    base, otherwise as quote of the first pair trading it as quote.
+    """
+    trans = normalize_transfers(trans)
+    trans = trans[(trans.amount != 0) & trans.type.isin(list(TRANSFER_TYPES))]
+    symbols = trans.currency.unique().tolist()
+    currencies = {}
+    for cur in Currency.query.filter(Currency.symbol.in_(symbols)).order_by(Currency.id):
+        currencies.setdefault(cur.symbol, cur)
+
+    # currency symbol -> (base_symbol, quote_symbol, booked as base)
+    booking = {}
+    for symbol, cur in currencies.items():
+        ex_pairs = pair_index.touching(ex.id, cur.id, active=False)
+        ex_pair = next((ep for ep in ex_pairs if ep.base_currency_id == cur.id), None)
+        as_base = ex_pair is not None
+        if not ex_pair:
+            ex_pair = next((ep for ep in ex_pairs if ep.quote_currency_id == cur.id), None)
+        if ex_pair:
+            booking[symbol] = (ex_pair.base_currency.symbol, ex_pair.quote_currency.symbol, as_base)
+        else:
+            log.warning(f'{ex} No pair for {symbol} transfers (skipping)')
+
+    trans = trans[trans.currency.isin(list(booking))]
+    t_type = trans.type.map(TRANSFER_TYPES)
+    amount = trans.amount.where(t_type == 'deposit', -trans.amount)
+    as_base = trans.currency.map(lambda symbol: booking[symbol][2]).astype(bool)
+    rows = pd.DataFrame({
+        'tx_id': trans.tx_id.astype(str),
+        'datetime': trans.index.str[0:19],
+        'timestamp': trans.timestamp.astype(np.int64),
+        'order_id': trans.order_id,
+        'tag': trans.tag,
+        'base_amount': amount.where(as_base, 0),
+        'quote_amount': amount.where(~as_base, 0),
+        'type': t_type,
+        'trade_type': None,
+        'base_symbol': trans.currency.map(lambda symbol: booking[symbol][0]),
+        'quote_symbol': trans.currency.map(lambda symbol: booking[symbol][1]),
+    }, index=trans.index)
+    return rows.reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    add_tx_index()
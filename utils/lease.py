@@ -0,0 +1,110 @@
+from threading import Event, Thread
+from uuid import uuid4
+from redis.exceptions import RedisError
+
+from database import *
+from .store import get_redis
+
+log = logging.getLogger(__name__)
+
+LEASE_TTL = int(os.getenv('CUBE_LEASE_TTL', 300))  # Seconds a crashed run keeps a cube locked
+HEARTBEAT = LEASE_TTL / 5  # Seconds between renewals while a task runs
+
+# Only the holder of the token may renew or release
+_RENEW = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_scripts = {}
+
+
+def _script(src):
+    if src not in _scripts:
+        _scripts[src] = get_redis().register_script(src)
+    return _scripts[src]
+
+
+def lease_key(cube_id):
+    return f'lease:cube:{cube_id}'
+
+
+def acquire(cube_id):
+    """ Token for the cube's processing lease, or None if it is held.
+    """
+    token = uuid4().hex
+    try:
+        if get_redis().set(lease_key(cube_id), token, nx=True, px=LEASE_TTL * 1000):
+            return token
+    except RedisError as e:
+        # Fail closed: two runs on one cube could double place orders
+        log.warning(f'Cube: {cube_id} Lease unavailable ({e})')
+    return None
+
+
+def renew(cube_id, token):
+    try:
+        return bool(_script(_RENEW)(keys=[lease_key(cube_id)],
+                                    args=[token, LEASE_TTL * 1000]))
+    except RedisError as e:
+        log.warning(f'Cube: {cube_id} Unable to renew lease ({e})')
+        return False
+
+
+def release(cube_id, token):
+    if not token:
+        return False
+    try:
+        return bool(_script(_RELEASE)(keys=[lease_key(cube_id)], args=[token]))
+    except RedisError as e:
+        log.warning(f'Cube: {cube_id} Unable to release lease ({e})')
+        return False
+
+
+def leased(cube_ids):
+    """ The subset of cube_ids currently being processed. """
+    cube_ids = list(cube_ids)
+    if not cube_ids:
+        return set()
+    pipe = get_redis().pipeline(transaction=False)
+    for cube_id in cube_ids:
+        pipe.exists(lease_key(cube_id))
+    return {cube_id for cube_id, held in zip(cube_ids, pipe.execute()) if held}
+
+
+class Heartbeat:
+    """ Renews a lease in the background for the duration of a with block.
+
+    A None token (task run outside process_cube) makes this a no-op.
+    """
+    def __init__(self, cube_id, token):
+        self.cube_id = cube_id
+        self.token = token
+        self.lost = False
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(HEARTBEAT):
+            if not renew(self.cube_id, self.token):
+                log.warning(f'Cube: {self.cube_id} Lease lost')
+                self.lost = True
+                return
+
+    def __enter__(self):
+        if self.token:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.token:
+            self._stop.set()
+            self._thread.join()
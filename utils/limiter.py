@@ -0,0 +1,137 @@
+import asyncio
+import json
+from hashlib import sha1
+from redis.exceptions import RedisError
+
+from database import *
+# Replacing datetime.time (Do not move)
+from time import time, sleep
+from .store import get_redis
+
+log = logging.getLogger(__name__)
+
+LIMITS_PATH = os.getenv(
+    'RATE_LIMITS_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                 'rate_limits.json'))
+LIMITS_KEY = 'ratelimit:limits'  # Calibrated limits shared by every host
+LIMITS_RELOAD = 300  # Seconds before re-reading the limits
+# Requests per second and bucket size, used for exchanges without calibrated limits.
+# Private limits apply per API key, public ones per exchange.
+DEFAULT_LIMITS = {
+    'public': {'rate': 10, 'burst': 10},
+    'private': {'rate': 2, 'burst': 5},
+}
+PUBLIC_ENDPOINTS = ['/midprice', '/details', '/orderbook']
+
+# Atomic token bucket. Returns 0 when a token was taken,
+# otherwise the milliseconds to wait before trying again.
+_TOKEN_BUCKET = """
+if redis.replicate_commands then redis.replicate_commands() end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return wait
+"""
+
+_limits = None
+_loaded_at = 0
+_script = None
+
+
+def load_limits():
+    """ Limits from Redis, or the local file if none were calibrated yet. """
+    global _limits, _loaded_at
+    limits = None
+    try:
+        raw = get_redis().hgetall(LIMITS_KEY)
+        limits = {k.decode(): json.loads(v) for k, v in raw.items()}
+    except RedisError as e:
+        log.warning(f'Rate limits unavailable ({e})')
+        if _limits is not None:
+            limits = _limits
+    if not limits:
+        try:
+            with open(LIMITS_PATH) as f:
+                limits = json.load(f)
+        except FileNotFoundError:
+            limits = {}
+    _limits, _loaded_at = limits, time()
+    return _limits
+
+
+def save_limits(limits):
+    global _limits
+    pipe = get_redis().pipeline()
+    pipe.delete(LIMITS_KEY)
+    if limits:
+        pipe.hmset(LIMITS_KEY, {ex: json.dumps(limit) for ex, limit in limits.items()})
+    pipe.execute()
+    _limits = limits
+
+
+def endpoint_class(endpoint):
+    for prefix in PUBLIC_ENDPOINTS:
+        if endpoint.startswith(prefix):
+            return 'public'
+    return 'private'
+
+
+def get_limit(exchange, endpoint_cls):
+    if _limits is None or time() - _loaded_at > LIMITS_RELOAD:
+        load_limits()
+    return _limits.get(exchange, {}).get(endpoint_cls, DEFAULT_LIMITS[endpoint_cls])
+
+
+def bucket_key(exchange, endpoint_cls, params=None):
+    key = f'ratelimit:{exchange}:{endpoint_cls}'
+    if endpoint_cls == 'private' and params and params.get('key'):
+        # Exchanges limit each API key separately
+        key += ':' + sha1(str(params['key']).encode()).hexdigest()[:16]
+    return key
+
+
+def take_token(exchange, endpoint, params=None):
+    # Returns seconds to wait (0 means go ahead)
+    global _script
+    endpoint_cls = endpoint_class(endpoint)
+    limit = get_limit(exchange, endpoint_cls)
+    try:
+        if _script is None:
+            _script = get_redis().register_script(_TOKEN_BUCKET)
+        wait = _script(keys=[bucket_key(exchange, endpoint_cls, params)],
+                       args=[limit['rate'], limit['burst']])
+    except RedisError as e:
+        # Fail open: an unavailable limiter must not stop trading
+        log.warning(f'Rate limiter unavailable ({e})')
+        return 0
+    return int(wait) / 1000
+
+
+def acquire(exchange, endpoint, params=None):
+    wait = take_token(exchange, endpoint, params)
+    while wait:
+        sleep(wait)
+        wait = take_token(exchange, endpoint, params)
+
+
+async def acquire_async(exchange, endpoint, params=None):
+    # The Redis call runs in a thread so other requests keep going meanwhile
+    loop = asyncio.get_event_loop()
+    wait = await loop.run_in_executor(None, take_token, exchange, endpoint, params)
+    while wait:
+        await asyncio.sleep(wait)
+        wait = await loop.run_in_executor(None, take_token, exchange, endpoint, params)
@@ -0,0 +1,116 @@
+import json
+from redis.exceptions import RedisError
+
+from database import *
+# Replacing datetime.time (Do not move)
+from time import time
+from .api import send_request
+from .async_api import get_client, run
+from .pairs import pair_index, invalidate_ex_pairs
+from .store import get_redis
+
+log = logging.getLogger(__name__)
+
+MARKETS_RELOAD = 300  # Seconds before a worker reloads its local copy
+
+# exchange name -> (loaded_at, {'BASE/QUOTE': market})
+_markets = {}
+
+
+def amount_precision(min_amt):
+    # Decimal places implied by the exchange's minimum amount (None if not a decimal)
+    if '.' in str(min_amt):
+        return len(str(min_amt).split('.')[1])
+    return None
+
+
+def to_market(details):
+    return {
+        'min_amt': details['min_amt'],
+        'min_val': details['min_val'],
+        'amt_precision': amount_precision(details['min_amt']),
+        'price_precision': details.get('price_precision'),
+    }
+
+
+def sync_markets(exchanges=None):
+    """ Bulk load /details for every active ExPair into the shared store.
+    """
+    if exchanges is None:
+        exchanges = Exchange.query.filter_by(active=True).all()
+    for ex in exchanges:
+        ex_pairs = ExPair.query.filter_by(exchange_id=ex.id, active=True).all()
+        if (set(ep.id for ep in ex_pairs) !=
+                set(ep.id for ep in pair_index.active(ex.id))):
+            # Pairs were (de)activated since the routing index was built
+            invalidate_ex_pairs()
+        if not ex_pairs:
+            continue
+        requests = [('GET', ex.name, '/details',
+                     {'base': ep.base_currency.symbol,
+                      'quote': ep.quote_currency.symbol})
+                    for ep in ex_pairs]
+        markets = {}
+        for ep, (status, details) in zip(ex_pairs, run(get_client().gather(requests))):
+            if status == 200 and details and 'min_amt' in details:
+                pair = f'{ep.base_currency.symbol}/{ep.quote_currency.symbol}'
+                markets[pair] = json.dumps(to_market(details))
+        log.info(f'{ex} Synced {len(markets)}/{len(ex_pairs)} markets')
+        if markets:
+            key = f'markets:{ex.name}'
+            pipe = get_redis().pipeline()
+            pipe.delete(key)
+            pipe.hmset(key, markets)
+            pipe.execute()
+        _markets.pop(ex.name, None)
+
+
+def load_markets(ex_name):
+    loaded = _markets.get(ex_name)
+    if loaded and time() - loaded[0] < MARKETS_RELOAD:
+        return loaded[1]
+    try:
+        raw = get_redis().hgetall(f'markets:{ex_name}')
+    except RedisError as e:
+        log.warning(f'Market store unavailable ({e})')
+        return loaded[1] if loaded else {}
+    markets = {k.decode(): json.loads(v) for k, v in raw.items()}
+    _markets[ex_name] = (time(), markets)
+    return markets
+
+
+def get_market(ex_pair):
+    """ Trade minimums and precision for ex_pair, or None if unknown.
+
+    Read from the local copy of the store; only pairs missing from the last
+    sync (e.g. new listings) go to EXAPI. A pair EXAPI has no details for
+    is remembered as unknown until the next reload.
+    """
+    ex_name = ex_pair.exchange.name
+    base = ex_pair.base_currency.symbol
+    quote = ex_pair.quote_currency.symbol
+    pair = f'{base}/{quote}'
+    markets = load_markets(ex_name)
+    if pair in markets:
+        return markets[pair]
+
+    log.debug(f'{ex_pair} missing from market store')
+    try:
+        r = send_request('GET', ex_name, '/details', {'base': base, 'quote': quote})
+    except Exception as e:
+        log.error(e)
+        return None
+    try:
+        details = r.json() if r.status_code == 200 else None
+    except ValueError:
+        details = None
+    if not details or 'min_amt' not in details:
+        markets[pair] = None
+        return None
+    market = to_market(details)
+    markets[pair] = market
+    try:
+        get_redis().hset(f'markets:{ex_name}', pair, json.dumps(market))
+    except RedisError:
+        pass
+    return market
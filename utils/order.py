@@ -1,12 +1,23 @@
 from database import *
+import json
 from decimal import Decimal as dec
 from math import trunc as truncate
+import numpy as np
+import pandas as pd
 
-from tools import trunc, get_ex_pair
+from tools import trunc
 from .api import get_api_creds, api_request, record_api_key_error, get_price
+from .async_api import api_requests, encode_params
+from .markets import get_market
+from .pairs import pair_index
 
 
 MAX_VAL = 0.25  # BTC
+# Exchanges whose EXAPI connector accepts POST /orders/batch
+BATCH_ORDER_EXCHANGES = [name for name in os.getenv('EXAPI_BATCH_ORDERS', '').split(',') if name]
+BATCH_ORDER_SIZE = int(os.getenv('EXAPI_BATCH_ORDER_SIZE', 5))
+# Exchanges whose EXAPI connector accepts DELETE /orders (every open order of a pair)
+CANCEL_ALL_EXCHANGES = [name for name in os.getenv('EXAPI_CANCEL_ALL', '').split(',') if name]
 
 
 def add_new_order(cube, ex_pair_id, order_id, side, price, amount):
@@ -27,6 +38,33 @@ def add_new_order(cube, ex_pair_id, order_id, side, price, amount):
     db_session.commit()
 
 
+def add_new_orders(cube, orders):
+    # orders: list of (ex_pair_id, order_id, side, price, amount), one insert
+    if not orders:
+        return
+    rows = []
+    for ex_pair_id, order_id, side, price, amount in orders:
+        log.info(f'{cube} New order {order_id} ({side} {amount} @ {price})')
+        rows.append({
+            'cube_id': cube.id,
+            'ex_pair_id': ex_pair_id,
+            'order_id': order_id,
+            'side': side,
+            'price': trunc(price),
+            'amount': trunc(amount),
+            'filled': 0,
+            'unfilled': trunc(amount),
+            'avg_price': 0,
+            'pending': True,
+        })
+    try:
+        db_session.execute(Order.__table__.insert().values(rows))
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+
+
 def bals_from_order(cube, ex_id, order_id):
     bal_base = Balance.query.filter_by(
         cube_id=cube.id,
@@ -64,6 +102,46 @@ def cancel_order(cube_id, exchange_id, order_id, base=None, quote=None):
         raise
 
 
+def cancel_orders_concurrently(cube, ex, orders, creds=None, by_pair=False):
+    # orders: list of (order_id, base, quote)
+    # Same result as calling cancel_order for each, with the DELETEs in flight
+    # together and the local orders removed in one transaction.
+    # by_pair: every open order on the pairs involved is to go, so exchanges
+    # in CANCEL_ALL_EXCHANGES get one cancel-all request per pair instead
+    if not orders:
+        return []
+    if creds is None:
+        creds = get_api_creds(cube, ex)
+    pairs, single = {}, []
+    for order_id, base, quote in orders:
+        log.info(f'{ex} {cube} Canceling order: {order_id}')
+        if by_pair and base and quote and ex.name in CANCEL_ALL_EXCHANGES:
+            pairs.setdefault((base, quote), []).append(order_id)
+        else:
+            single.append((order_id, base, quote))
+    canceled = []
+    requests = [('DELETE', ex.name, '/orders', {**creds, 'base': base, 'quote': quote})
+                for base, quote in pairs]
+    for ((base, quote), order_ids), result in zip(pairs.items(),
+                                                  api_requests(cube, ex, requests)):
+        if result and result != 'InvalidOrder':
+            canceled.extend(order_ids)
+        else:
+            log.debug(f'{ex} {cube} Unable to cancel all {base}/{quote} orders '
+                      '(canceling individually)')
+            single.extend((order_id, base, quote) for order_id in order_ids)
+    requests = [('DELETE', ex.name, f'/order/{order_id}',
+                 {**creds, 'base': base, 'quote': quote})
+                for order_id, base, quote in single]
+    for (order_id, _, _), result in zip(single, api_requests(cube, ex, requests)):
+        if result:
+            canceled.append(order_id)
+        else:
+            log.debug(f'{cube} order {order_id} not found')
+    delete_orders(cube, [order_id for order_id, _, _ in orders])
+    return canceled
+
+
 def delete_order(cube, order_id):
     try:
         # Delete from database
@@ -74,16 +152,21 @@ def delete_order(cube, order_id):
         pass
 
 
-def place_order(cube_id, ex_pair_id, side, amount, price):
-    cube = Cube.query.get(cube_id)
-    ex_pair = ExPair.query.filter_by(id=ex_pair_id).first()
+def delete_orders(cube, order_ids):
+    # delete_order for many, in one transaction
+    for order_id in order_ids:
+        cube.all_orders.pop(order_id, None)
+    db_session.add(cube)
+    db_session.commit()
+
+
+def order_params(cube, ex_pair, side, amount, price, creds=None):
     log.info(f'{ex_pair.exchange} {cube} Placing {side} order for {amount} \
              {ex_pair.base_currency.symbol} @ {price} {ex_pair.quote_currency.symbol}')
-    # Get API credentials
-    creds = get_api_creds(cube, ex_pair.exchange)
-
-    # Params
-    params = {
+    if creds is None:
+        # Get API credentials
+        creds = get_api_creds(cube, ex_pair.exchange)
+    return {
         # Auth credentials
         **creds,
         # Order details
@@ -94,8 +177,9 @@ def place_order(cube_id, ex_pair_id, side, amount, price):
         'quote': ex_pair.quote_currency.symbol,
         'type': 'limit',
     }
-    # Place order on exchange
-    order_id = api_request(cube, 'POST', ex_pair.exchange.name, '/orders', params)
+
+
+def record_order(cube, ex_pair, side, amount, price, order_id):
     log.debug(order_id)
     if order_id and order_id == 'InvalidOrder':
         log.debug(f'{cube} {ex_pair.exchange} {ex_pair.base_currency} reached target (below trade minimum)')
@@ -124,231 +208,326 @@ def place_order(cube_id, ex_pair_id, side, amount, price):
         log.debug(f'{cube} {ex_pair} Unable to place order')
 
 
-def failsafe(cube, i):
-    # Valuation currency is balanced via other currencies
-    if i.cur == cube.val_cur:
-        log.debug(f'{cube} {i.ex} {i.cur} Valuation currency \
-                    balanced via other currencies')
-        b = Balance.query.filter_by(
-            cube=cube,
-            exchange=i.ex,
-            currency=i.cur
-        ).first()
-        b.target = None
-        db_session.add(b)
-        return True
-    # Target is removed when reached
-    # Check for either None or nan...
-    if (i.bal_tgt is None) or (i.bal_tgt != i.bal_tgt):
-        log.debug(f'{cube} {i.ex} {i.cur} already at target')
-        return True
-    # Failsafe: if external or manual, clear balance target and continue (cannot trade)
-    if i.ex.name in ['External', 'Manual']:
-        b = Balance.query.filter_by(
-            cube=cube,
-            exchange=i.ex,
-            currency=i.cur
-        ).first()
-        log.warning(f'{cube} Resetting balance target for {i.ex} {i.cur}')
-        b.target = None
-        db_session.add(b)
-        return True
-    return False
+def place_order(cube_id, ex_pair_id, side, amount, price):
+    cube = Cube.query.get(cube_id)
+    ex_pair = ExPair.query.filter_by(id=ex_pair_id).first()
+    params = order_params(cube, ex_pair, side, amount, price)
+    # Place order on exchange
+    order_id = api_request(cube, 'POST', ex_pair.exchange.name, '/orders', params)
+    return record_order(cube, ex_pair, side, amount, price, order_id)
 
 
-def get_order_details(cube, ex_pair, bal_diff, price, inverted):
-    # Determine order side
-    if bal_diff > 0:
-        side = 'sell'
-    else:
-        side = 'buy'
-    # Determine order size
-    amount = abs(bal_diff)
-    val = float(amount) * float(price)
-    # Limit order size if necessary
-    # Need to think of new solution for order size max calculation
-    # Perhaps use a percentage of the last candle volume?
-    # if val > MAX_VAL:
-    #     log.debug(f'{cube} Limiting {ex_pair}')
-    #     val = MAX_VAL
-    #     amount = float(val) / float(price)
-    # Flip order data if base/quote inverted
-    if inverted:
-        log.debug(f'Flipping order data for {ex_pair}')
-        side = 'buy' if side == 'sell' else 'sell'
-        amount, val = val, amount
-        price = 1 / price
-        amount = amount * 0.99
-    log.debug(f'Amount={amount}, Price={price}, Value={val}')
-    return side, amount, val, price
-
-
-def below_trade_min(cube, ex_pair, bal_tgt, val_diff_pct, amount, val):
-    # Get currency
-    ex = ex_pair.exchange
-    # Check if order meets trade minimum
+def record_orders(cube, placed):
+    # placed: list of (ex_pair, side, amount, price, order_id)
+    # Same result as record_order for each, with the new orders in one insert
+    new, order_ids = [], []
+    for ex_pair, side, amount, price, order_id in placed:
+        if order_id and order_id != 'InvalidOrder' and 'error' not in order_id:
+            new.append((ex_pair.id, order_id, side, price, amount))
+            order_ids.append(order_id)
+        else:
+            order_ids.append(record_order(cube, ex_pair, side, amount, price, order_id))
     try:
-        params = {
-            'base': ex_pair.base_currency.symbol,
-            'quote': ex_pair.quote_currency.symbol
-        }
-        d = api_request(
-                cube, 
-                'GET', 
-                ex_pair.exchange.name, 
-                '/details',
-                params
-                )
-    except AttributeError:
-        # Exchange is probably external... not performing minimum checks
-        log.warning(f'{cube} No details for {ex_pair}')
-        d = None
+        add_new_orders(cube, new)
     except Exception as e:
-        log.error(e)
-        d = None
-    else:
-        if d and (amount < d['min_amt'] or val < d['min_val']):
-            # Below trade minimum
-            # Consider the target reached
-            log.debug(f'{cube} {ex} {ex_pair.base_currency} reached target')
-            b = Balance.query.filter_by(
-                cube=cube,
-                exchange=ex,
-                currency=ex_pair.base_currency
-            ).first()
-            b.target = None
-            db_session.add(b)
-            db_session.commit()
-            return True
-    if bal_tgt != 0:
-        if abs(dec(val_diff_pct)) < dec(cube.threshold / 100):
-            # Below threshold, target reached
-            log.info('%s %s %s below threshold' % (cube, ex, ex_pair.base_currency))
-            b = Balance.query.filter_by(
-                cube=cube,
-                exchange=ex,
-                currency=ex_pair.base_currency
-            ).first()
-            b.target = None
-            db_session.add(b)
-            db_session.commit()
-            return True
-    return False
-
-
-def throttle_order(cube, ex_pair, indiv, ex_id, side, amount, val, price):
-    # Check for available balance
-    if side == 'sell':
-        bal = indiv['bal'][ex_pair.base_currency_id, ex_id]
-        if amount > bal:
-            # Insufficient balance. Reducing order amount
-            amount = bal
-            val = amount * price
-            log.debug(f'{cube} Reducing {ex_pair} order to {amount} \
-                        {ex_pair.base_currency}')
-    else:  # buy
-        bal = indiv['bal'][ex_pair.quote_currency_id, ex_id]
-        if val > bal:
-            # Insufficient balance. Reducing order amount
-            val = bal
-            amount = val / price
-            log.debug(f'{cube} Reducing {ex_pair} order to {amount} \
-                       {ex_pair.base_currency}')
-
-    log.debug(f'{cube} truncating precision')
-    try:
-        params = {
-            'base': ex_pair.base_currency.symbol,
-            'quote': ex_pair.quote_currency.symbol
-        }
-        d = api_request(
-                cube, 
-                'GET', 
-                ex_pair.exchange.name, 
-                '/details',
-                params
-                )
-    except AttributeError:
-        # Exchange is probably external... not performing minimum checks
-        log.warning(f'{cube} No details for {ex_pair}')
-        d = None
-    else:
-        if d:
-            if '.' in str(d['min_amt']):
-                precision = len(str(d['min_amt']).split('.')[1])
-                amount = round(amount, precision)
-                log.debug(f'Precision: {precision}')
-            elif amount >= 1:
-                amount = truncate(amount)
-            
-            log.debug(f'Amount: {amount}')
-
-    return amount, val
+        log.warn(f'{cube} Unable to add {len(new)} orders to database')
+        log.warn(e)
+        failed = {order_id for _, order_id, _, _, _ in new}
+        order_ids = [None if order_id in failed else order_id for order_id in order_ids]
+    return order_ids
+
+
+def submit_orders(cube, ex, creds, ex_orders):
+    # ex_orders: list of (ex_pair, side, amount, price), one POST each
+    requests = [('POST', ex.name, '/orders',
+                 order_params(cube, ex_pair, side, amount, price, creds))
+                for ex_pair, side, amount, price in ex_orders]
+    return api_requests(cube, ex, requests)
+
+
+def submit_order_batches(cube, ex, creds, ex_orders):
+    """ Up to BATCH_ORDER_SIZE orders per POST /orders/batch.
+
+    The response lists an order id (or error) per order. A rejected batch
+    (400) is resent order by order. AsyncClient.send only retries a POST
+    that never reached EXAPI (connection refused, connect timeout or 429),
+    so a batch with an unknown outcome (read timeout, 5xx) is not resent;
+    its orders get no id here and anything it placed is swept as rogue on
+    the next reconcile.
+    """
+    chunks = [ex_orders[i:i + BATCH_ORDER_SIZE]
+              for i in range(0, len(ex_orders), BATCH_ORDER_SIZE)]
+    requests = []
+    for chunk in chunks:
+        batch = [encode_params(order_params(cube, ex_pair, side, amount, price, {}))
+                 for ex_pair, side, amount, price in chunk]
+        requests.append(('POST', ex.name, '/orders/batch',
+                         {**creds, 'orders': json.dumps(batch)}))
+    order_ids = []
+    for chunk, result in zip(chunks, api_requests(cube, ex, requests)):
+        if isinstance(result, list) and len(result) == len(chunk):
+            order_ids.extend(result)
+        elif result == 'InvalidOrder':
+            log.debug(f'{ex} {cube} Batch rejected (placing orders individually)')
+            order_ids.extend(submit_orders(cube, ex, creds, chunk))
+        else:
+            log.warning(f'{ex} {cube} Batch order failed ({result})')
+            order_ids.extend([None] * len(chunk))
+    return order_ids
+
+
+def place_orders_concurrently(cube, orders):
+    # orders: list of (amount, price, ex_pair_id, side) from target_orders
+    # Same result as calling place_order for each: credentials are read once
+    # per exchange, the POSTs are in flight together (batched where EXAPI
+    # supports it) and the orders are recorded in one insert
+    pair_index.refresh()
+    by_exchange = {}
+    for amount, price, ex_pair_id, side in orders:
+        ex_pair = pair_index.ex_pair(ex_pair_id)
+        by_exchange.setdefault(ex_pair.exchange, []).append(
+            (ex_pair, side, amount, price))
+    placed = []
+    for ex, ex_orders in by_exchange.items():
+        creds = get_api_creds(cube, ex)
+        if ex.name in BATCH_ORDER_EXCHANGES:
+            order_ids = submit_order_batches(cube, ex, creds, ex_orders)
+        else:
+            order_ids = submit_orders(cube, ex, creds, ex_orders)
+        placed.extend((*order, order_id) for order, order_id in zip(ex_orders, order_ids))
+    return record_orders(cube, placed)
 
 
-def create_order(cube, ex_pair, i, indiv, price, orders, inverted=False):
-    side, amount, val, price = get_order_details(cube, ex_pair, i.bal_diff, price, inverted)
+def clear_targets(cube, keys):
+    # Target reached (or untradeable): remove targets of (cur_id, ex_id) balances
+    keys = set(keys)
+    if not keys:
+        return
+    for b in cube.balances:
+        if (b.currency_id, b.exchange_id) in keys:
+            b.target = None
+            db_session.add(b)
+    db_session.commit()
 
-    if below_trade_min(cube, ex_pair, i.bal_tgt, i.val_diff_pct, amount, val):
-        return False
 
-    amount, val = throttle_order(cube, ex_pair, indiv, ex_pair.exchange.id, side, amount, val, price)
+def failsafe(cube, indiv):
+    """ Rows of indiv which are not traded.
 
-    orders.append((amount, price, ex_pair.id, side))
-    db_session.commit()
-    return True
+    Returns a boolean mask of those rows and the (cur_id, ex_id) keys whose
+    balance target is cleared.
+    """
+    cur_ids = indiv.index.get_level_values('cur_id').values
+    # Valuation currency is balanced via other currencies
+    is_val = cur_ids == cube.val_cur.id
+    # Target is removed when reached (None or nan)
+    no_tgt = indiv.bal_tgt.isnull().values
+    # External or manual balances cannot be traded
+    external = indiv.ex.map(lambda ex: ex.name in ['External', 'Manual']).values.astype(bool)
+    for cur_id, ex_id in indiv.index[~is_val & ~no_tgt & external]:
+        log.warning(f'{cube} Resetting balance target for {ex_id} {cur_id}')
+    skip = is_val | no_tgt | external
+    clear = is_val | (~no_tgt & external)
+    return skip, list(indiv.index[clear])
+
+
+def market_table(pair_ids):
+    # Trade minimums and amount precision per pair (NaN where unknown)
+    rows = {}
+    for pair_id in set(pair_ids):
+        d = get_market(pair_index.ex_pair(pair_id))
+        if d:
+            precision = d['amt_precision']
+            rows[pair_id] = (True, d['min_amt'], d['min_val'],
+                             np.nan if precision is None else precision)
+        else:
+            rows[pair_id] = (False, np.nan, np.nan, np.nan)
+    table = pd.DataFrame.from_dict(
+        rows, orient='index', columns=['known', 'min_amt', 'min_val', 'precision'])
+    return table.reindex(pair_ids)
+
+
+def plan_orders(cube, indiv, cands):
+    """ Order side, size and price for candidate rows, without side effects.
+
+    cands needs ex_pair_id, ex_id, base_id, quote_id, bal_diff, bal_tgt,
+    val_diff_pct, price and inverted columns. Adds side, amount and price
+    (flipped for inverted pairs), 'reached' where the target counts as
+    reached (below trade minimum or threshold), 'missing' where the
+    balance the order is throttled against is not in indiv, and
+    'throttled' where the order was cut to the available balance.
+    """
+    plan = cands.copy()
+    price = plan.price.values.astype(float)
+    inverted = plan.inverted.values.astype(bool)
+    # Determine order side and size
+    sell = plan.bal_diff.values > 0
+    amount = np.abs(plan.bal_diff.values.astype(float))
+    val = amount * price
+    # Flip order data if base/quote inverted
+    sell = sell ^ inverted
+    amount, val = np.where(inverted, val * 0.99, amount), np.where(inverted, amount, val)
+    order_price = plan.price.astype(object)
+    order_price[inverted] = 1 / order_price[inverted]
+    price = order_price.values.astype(float)
+
+    # Below trade minimum or threshold: consider the target reached
+    mkt = market_table(plan.ex_pair_id.values)
+    known = mkt.known.fillna(False).values.astype(bool)
+    below_min = known & ((amount < mkt.min_amt.values) | (val < mkt.min_val.values))
+    threshold = float(dec(cube.threshold / 100))
+    below_thr = ((plan.bal_tgt.values != 0) &
+                 (np.abs(plan.val_diff_pct.values.astype(float)) < threshold))
+    reached = below_min | below_thr
+
+    # Limit to available balance
+    bal_cur = np.where(sell, plan.base_id.values, plan.quote_id.values)
+    avail = indiv['bal'].reindex(
+        pd.MultiIndex.from_arrays([bal_cur, plan.ex_id.values])).values
+    missing = ~reached & np.isnan(avail)
+    cut_sell = sell & (amount > avail)
+    cut_buy = ~sell & (val > avail)
+    amount = np.where(cut_sell, avail, np.where(cut_buy, avail / price, amount))
+
+    # Truncate precision (python floats round differently from numpy floats)
+    amounts = amount.astype(object)
+    py_float = inverted & ~cut_sell & ~cut_buy
+    precision = mkt.precision.values
+    for p in np.unique(precision[known & ~np.isnan(precision)]):
+        rows = known & (precision == p)
+        amounts[rows & ~py_float] = list(np.round(amount[rows & ~py_float], int(p)))
+        amounts[rows & py_float] = [round(float(a), int(p)) for a in amount[rows & py_float]]
+    whole = known & np.isnan(precision) & (amount >= 1)
+    amounts[whole] = [truncate(a) for a in amount[whole]]
+
+    plan['side'] = np.where(sell, 'sell', 'buy')
+    plan['amount'] = amounts
+    plan['price'] = order_price.values
+    plan['reached'] = reached
+    plan['missing'] = missing
+    plan['throttled'] = cut_sell | cut_buy
+    return plan
+
+
+def to_orders(plan):
+    return [(float(a) if not isinstance(a, int) else a, p, int(ex_pair_id), side)
+            for a, p, ex_pair_id, side in zip(plan.amount, plan.price,
+                                              plan.ex_pair_id, plan.side)]
 
 
 def secondary_pairs(cube, indiv, comb, orders):
     log.debug(f'{cube} running secondary pairs')
-    for (cur_id, ex_id), i in indiv.iterrows():
-        # Check to see if any of the other assets (except val_cur which is BTC) has a surplus or deficit which is opposed to this asset
-        # Find all active ex_pairs on this exchange which are not val_cur
-
-        if failsafe(cube, i):
+    # Trade each asset against the other (non val_cur) asset of its pairs
+    skip, clear = failsafe(cube, indiv)
+    rows = indiv.reset_index()
+    rows['pos'] = np.arange(len(rows))
+    pairs = pair_index.table()
+    pairs = pairs[pairs.quote_id != cube.val_cur.id]
+    cands = rows[~skip].merge(pairs, left_on=['ex_id', 'cur_id'],
+                              right_on=['ex_id', 'base_id'])
+    cands = cands.sort_values(['pos', 'ex_pair_id'], kind='mergesort').reset_index(drop=True)
+    cands['inverted'] = False
+
+    prices = {}
+    for pair_id in cands.ex_pair_id.unique():
+        ex_pair = pair_index.ex_pair(pair_id)
+        try:
+            prices[pair_id] = get_price(ex_pair.exchange.name,
+                                        ex_pair.base_currency.symbol,
+                                        ex_pair.quote_currency.symbol)
+        except Exception as e:
+            log.debug(f'{cube} price query failed for {ex_pair}: {e}')
+    priced = cands.ex_pair_id.isin(list(prices)).values
+    cands['price'] = cands.ex_pair_id.map(prices)
+    plan = plan_orders(cube, indiv, cands[priced])
+
+    # Walk candidates in order: each order offsets the val_diff of its
+    # base and quote so as not to attempt more trades than possible
+    sphinx = cube.algorithm.name == 'Sphinx'
+    val_diff = dict(zip(indiv.index, indiv.val_diff))
+    taken = []
+    for c in cands.itertuples():
+        if not sphinx:
+            quote = (c.quote_id, c.ex_id)
+            if quote not in val_diff:
+                log.debug(f'{cube} exeception in secondary pair: {quote} not in indiv')
+                break
+            quote_val_diff = val_diff[quote]
+            # Make sure quote val_diff >= base val_diff
+            # We don't want to trade more of the base value than the quote value
+            if not abs(quote_val_diff) >= abs(c.val_diff):
+                continue
+        if not priced[c.Index]:
+            log.debug(f'{cube} exeception in secondary pair: no price for {c.ex_pair_id}')
+            break
+        o = plan.loc[c.Index]
+        if o.reached:
+            clear.append((c.cur_id, c.ex_id))
             continue
+        if o.missing:
+            log.debug(f'{cube} exeception in secondary pair: no balance to throttle {c.ex_pair_id}')
+            break
+        if o.throttled and isinstance(o.price, dec):
+            # Throttling float balances against a Decimal price raised a
+            # TypeError in the row loop, which ended the secondary pass
+            log.debug(f'{cube} exeception in secondary pair: unable to throttle {c.ex_pair_id}')
+            break
+        taken.append(c.Index)
+        if not sphinx:
+            val_diff[quote] += c.val_diff
+            val_diff[(c.cur_id, c.ex_id)] += quote_val_diff
 
-        ex_pairs = ExPair.query.filter_by(
-                                    exchange_id=ex_id,
-                                    active=True
-                                    ).filter(
-                                    ExPair.base_currency == i.cur,
-                                    ExPair.quote_currency != cube.val_cur,
-                                    ).all()
-        if ex_pairs:
-            for ex_pair in ex_pairs:
-                if cube.algorithm.name == 'Sphinx':
-                    price = get_price(ex_pair.exchange.name, ex_pair.base_currency.symbol, ex_pair.quote_currency.symbol)
-                    if create_order(cube, ex_pair, i, indiv, price, orders, inverted=False):
-                        log.debug(f'{cube} order created for {ex_pair}')
-                else:
-                    # Check for corresponding positive or negative value for quote
-                    quote_val_diff = indiv.loc[(ex_pair.quote_currency_id, ex_id), 'val_diff']
-                    # Make sure quote val_diff >= base val_diff
-                    # We don't want to trade more of the base value than the quote value
-                    if abs(quote_val_diff) >= abs(i.val_diff):
-                        # Get ex_pair price
-                        price = get_price(ex_pair.exchange.name, ex_pair.base_currency.symbol, ex_pair.quote_currency.symbol)
-                        if create_order(cube, ex_pair, i, indiv, price, orders, inverted=False):
-                            log.debug(f'{cube} order created for {ex_pair}')
-                            # Offest val_diff for base and quote so as not to attempt to place more trades than possible
-                            indiv.loc[(ex_pair.quote_currency_id, ex_id), 'val_diff'] += i.val_diff
-                            indiv.loc[(ex_pair.base_currency_id, ex_id), 'val_diff'] += quote_val_diff
+    indiv['val_diff'] = [val_diff[k] for k in indiv.index]
+    new_orders = to_orders(plan.loc[taken])
+    for order in new_orders:
+        log.debug(f'{cube} order created for {order}')
+    orders.extend(new_orders)
+    clear_targets(cube, clear)
 
 
 def primary_pairs(cube, indiv, comb, orders):
     log.debug(f'{cube} running primary pairs')
-    for (cur_id, ex_id), i in indiv.iterrows():
-
-        if failsafe(cube, i):
-            continue
-
-        # Get expair and price
-        ex_pair, inverted = get_ex_pair(i.ex, i.cur, cube.val_cur)
-        price = comb['price'][cur_id]
-
-        if create_order(cube, ex_pair, i, indiv, price, orders, inverted):
-            log.debug(f'{cube} order created for {ex_pair}')
+    # Trade each asset against val_cur
+    skip, _ = failsafe(cube, indiv)
+    val_cur_id = cube.val_cur.id
+    rows = indiv.reset_index()
+    rows['pos'] = np.arange(len(rows))
+    rows['clear'] = (rows.cur_id == val_cur_id) | (rows.bal_tgt.notnull() & skip)
+    routes = pair_index.routes(val_cur_id).rename(columns={'pair_id': 'ex_pair_id'})
+    cands = rows[~skip].merge(routes, how='left', on=['ex_id', 'cur_id'])
+    cands['inverted'] = cands.inverted.fillna(False).astype(bool)
+    cands['base_id'] = np.where(cands.inverted, val_cur_id, cands.cur_id)
+    cands['quote_id'] = np.where(cands.inverted, cands.cur_id, val_cur_id)
+    cands['price'] = comb['price'].reindex(cands.cur_id).values
+
+    # Rows after the first failure are not processed (as in the row loop)
+    error = None
+    no_pair = cands.ex_pair_id.isnull().values
+    no_price = np.isnan(cands.price.values.astype(float))
+    bad = no_pair | no_price
+    plan = plan_orders(cube, indiv, cands[~bad])
+    failed = bad.copy()
+    failed[~bad] = plan.missing.values
+    if failed.any():
+        first = np.flatnonzero(failed)[0]
+        c = cands.iloc[first]
+        if no_pair[first]:
+            error = ValueError(f'No ExPair involving {c.cur} and {cube.val_cur} on {c.ex}')
+        elif no_price[first]:
+            error = KeyError(c.cur_id)
+        else:
+            error = KeyError((c.cur_id, c.ex_id))
+        plan = plan[plan.pos < c.pos]
+        rows = rows[rows.pos < c.pos]
+
+    clear = list(zip(rows.cur_id[rows.clear], rows.ex_id[rows.clear]))
+    clear += list(zip(plan.base_id[plan.reached], plan.ex_id[plan.reached]))
+    new_orders = to_orders(plan[~plan.reached])
+    for order in new_orders:
+        log.debug(f'{cube} order created for {order}')
+    orders.extend(new_orders)
+    clear_targets(cube, clear)
+    if error is not None:
+        raise error
 
 
 def target_orders(cube, indiv, comb, orders):
@@ -0,0 +1,207 @@
+from collections import namedtuple
+import pandas as pd
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload, object_session
+from redis.exceptions import RedisError
+
+from database import *
+# Replacing datetime.time (Do not move)
+from time import time
+from .store import get_redis
+
+log = logging.getLogger(__name__)
+
+VERSION_KEY = 'expairs:version'
+CHECK_INTERVAL = 30  # Seconds between version checks
+MAX_AGE = 3600  # Seconds before rebuilding even without a version bump
+
+PairRow = namedtuple('PairRow', ['id', 'exchange_id', 'base_currency_id', 'quote_currency_id',
+                                 'base_symbol', 'quote_symbol', 'active'])
+
+
+class ExPairIndex:
+    """ Process-wide routing index of ExPairs.
+
+    Built from one query and rebuilt when the version in Redis is bumped
+    (see invalidate_ex_pairs). Lookups return ExPair objects from the current
+    db_session, which are bulk loaded once per exchange per session.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.built_at = 0
+        self.checked_at = 0
+        self.rows = {}  # pair_id -> PairRow
+        self.by_pair = {}  # (ex_id, base_id, quote_id) -> pair_id
+        self.by_symbols = {}  # (ex_id, base_symbol, quote_symbol) -> pair_id
+        self.by_currency = {}  # (ex_id, cur_id) -> [pair_id]
+        self.by_symbol = {}  # (ex_id, symbol) -> [pair_id]
+        self._routes = {}  # quote_id -> routing table (None -> pair table)
+        self._session = None
+        self._objects = {}  # ex_id -> {pair_id: ExPair} for self._session
+
+    def get_version(self):
+        try:
+            return int(get_redis().get(VERSION_KEY) or 0)
+        except RedisError as e:
+            log.warning(f'ExPair index version unavailable ({e})')
+            return self.version
+
+    def build(self):
+        rows = db_session.query(
+            ExPair.id, ExPair.exchange_id,
+            ExPair.base_currency_id, ExPair.quote_currency_id,
+            ExPair.base_symbol, ExPair.quote_symbol, ExPair.active,
+        ).order_by(ExPair.id).all()
+        self.rows, self.by_pair, self.by_symbols = {}, {}, {}
+        self.by_currency, self.by_symbol = {}, {}
+        for r in rows:
+            row = PairRow(*r)
+            self.rows[row.id] = row
+            self.by_symbols.setdefault(
+                (row.exchange_id, row.base_symbol, row.quote_symbol), row.id)
+            if row.active:
+                self.by_pair.setdefault(
+                    (row.exchange_id, row.base_currency_id, row.quote_currency_id), row.id)
+            for cur_id, symbol in [(row.base_currency_id, row.base_symbol),
+                                   (row.quote_currency_id, row.quote_symbol)]:
+                self.by_currency.setdefault((row.exchange_id, cur_id), []).append(row.id)
+                self.by_symbol.setdefault((row.exchange_id, symbol), []).append(row.id)
+        self._routes = {}
+        self._objects = {}
+        self.built_at = time()
+        log.debug(f'ExPair index built ({len(self.rows)} pairs, version {self.version})')
+
+    def refresh(self):
+        now = time()
+        if self.rows and now - self.checked_at < CHECK_INTERVAL:
+            return
+        self.checked_at = now
+        version = self.get_version()
+        if not self.rows or version != self.version or now - self.built_at > MAX_AGE:
+            self.version = version
+            self.build()
+
+    def ex_pair(self, pair_id):
+        session = db_session()
+        if session is not self._session:
+            self._session = session
+            self._objects = {}
+        row = self.rows[pair_id]
+        objects = self._objects.get(row.exchange_id)
+        if objects is None:
+            # Every active pair on the exchange in one query
+            objects = {ep.id: ep for ep in ExPair.query.options(
+                joinedload('base_currency'),
+                joinedload('quote_currency'),
+                joinedload('exchange'),
+            ).filter_by(exchange_id=row.exchange_id, active=True).all()}
+            self._objects[row.exchange_id] = objects
+        if pair_id not in objects:
+            # Inactive pair
+            objects[pair_id] = ExPair.query.get(pair_id)
+        return objects[pair_id]
+
+    def find(self, ex_id, base_id, quote_id):
+        # Active pair trading base against quote, either way round
+        self.refresh()
+        pair_id = self.by_pair.get((ex_id, base_id, quote_id))
+        if pair_id is not None:
+            return self.ex_pair(pair_id), False
+        pair_id = self.by_pair.get((ex_id, quote_id, base_id))
+        if pair_id is not None:
+            return self.ex_pair(pair_id), True
+        return None
+
+    def symbols(self, ex_id):
+        # (base_symbol, quote_symbol) of every pair (active or not)
+        self.refresh()
+        return set((base, quote) for (pair_ex_id, base, quote) in self.by_symbols
+                   if pair_ex_id == ex_id)
+
+    def touching(self, ex_id, cur_id, active=True):
+        # Pairs with cur_id as base or quote, in id order
+        self.refresh()
+        return [self.ex_pair(pair_id)
+                for pair_id in self.by_currency.get((ex_id, cur_id), [])
+                if self.rows[pair_id].active or not active]
+
+    def touching_symbol(self, ex_id, symbol):
+        self.refresh()
+        return [self.ex_pair(pair_id)
+                for pair_id in self.by_symbol.get((ex_id, symbol), [])
+                if self.rows[pair_id].active]
+
+    def table(self):
+        # Active pairs as columns, in id order
+        self.refresh()
+        if None not in self._routes:
+            self._routes[None] = pd.DataFrame(
+                [(row.id, row.exchange_id, row.base_currency_id, row.quote_currency_id)
+                 for row in self.rows.values() if row.active],
+                columns=['ex_pair_id', 'ex_id', 'base_id', 'quote_id'])
+        return self._routes[None]
+
+    def routes(self, quote_id):
+        """ Table of (ex_id, cur_id) -> (pair_id, inverted) for every currency
+        with an active pair against quote_id, preferring direct pairs like find().
+        """
+        self.refresh()
+        if quote_id not in self._routes:
+            rows = []
+            for row in self.rows.values():
+                if not row.active:
+                    continue
+                if row.quote_currency_id == quote_id:
+                    rows.append((row.exchange_id, row.base_currency_id, row.id, False))
+                elif row.base_currency_id == quote_id:
+                    rows.append((row.exchange_id, row.quote_currency_id, row.id, True))
+            routes = pd.DataFrame(rows, columns=['ex_id', 'cur_id', 'pair_id', 'inverted'])
+            routes = routes.sort_values('inverted', kind='mergesort')
+            self._routes[quote_id] = routes.drop_duplicates(['ex_id', 'cur_id'])
+        return self._routes[quote_id]
+
+    def active(self, ex_id):
+        self.refresh()
+        return [self.ex_pair(row.id) for row in self.rows.values()
+                if row.exchange_id == ex_id and row.active]
+
+    def quote_ids(self, ex_id):
+        self.refresh()
+        return set(row.quote_currency_id for row in self.rows.values()
+                   if row.exchange_id == ex_id and row.active)
+
+
+pair_index = ExPairIndex()
+
+
+def invalidate_ex_pairs():
+    # Call after activating/deactivating ExPairs so every worker rebuilds
+    try:
+        get_redis().incr(VERSION_KEY)
+    except RedisError as e:
+        log.warning(f'Unable to bump ExPair index version ({e})')
+    pair_index.rows = {}
+
+
+def _expair_written(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['expairs_changed'] = True
+
+
+def _bump_after_commit(session):
+    if session.info.pop('expairs_changed', False):
+        invalidate_ex_pairs()
+
+
+def _forget_on_rollback(session, previous_transaction):
+    session.info.pop('expairs_changed', None)
+
+
+# Any ExPair insert/update/delete made through the ORM invalidates the index
+# once committed; sync_markets' hourly comparison catches writes made elsewhere
+for _event in ['after_insert', 'after_update', 'after_delete']:
+    event.listen(ExPair, _event, _expair_written)
+event.listen(Session, 'after_commit', _bump_after_commit)
+event.listen(Session, 'after_soft_rollback', _forget_on_rollback)
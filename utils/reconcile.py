@@ -2,6 +2,7 @@ from decimal import Decimal as dec
 
 from tools import (trunc, add_new_balance, cur_ids_from_balances)
 from database import *
+from .pairs import pair_index
 
 FEE_THRESH = dec('0.01')
 
@@ -9,13 +10,8 @@ FEE_THRESH = dec('0.01')
 def remove_delisted(cube, ex):
     log.debug(f'{cube} Removing delisted')
     for bal in cube.balances:
-        ex_pair = ExPair.query.filter_by(
-            exchange_id=ex.id,
-            active=True
-        ).filter(or_(
-            ExPair.quote_currency_id == bal.currency.id,
-            ExPair.base_currency_id == bal.currency.id
-        )).first()
+        ex_pairs = pair_index.touching(ex.id, bal.currency_id)
+        ex_pair = ex_pairs[0] if ex_pairs else None
         if not ex_pair:
             log.debug(f'{ex_pair} not active so {bal} is being set to 0...')
             bal.available = 0
@@ -28,21 +24,10 @@ def remove_delisted(cube, ex):
 def get_currency(exchange, symbol):
     currency = Currency.query.filter_by(symbol=symbol).first()
     if currency:
-        ex_pair = ExPair.query.filter_by(
-            exchange_id=exchange.id,
-            active=True
-        ).filter(or_(
-            ExPair.quote_currency_id == currency.id,
-            ExPair.base_currency_id == currency.id
-        )).first()
+        ex_pairs = pair_index.touching(exchange.id, currency.id)
     else:
-        ex_pair = ExPair.query.filter_by(
-            exchange_id=exchange.id,
-            active=True
-        ).filter(or_(
-            ExPair.quote_symbol == symbol,
-            ExPair.base_symbol == symbol
-        )).first()
+        ex_pairs = pair_index.touching_symbol(exchange.id, symbol)
+    ex_pair = ex_pairs[0] if ex_pairs else None
     if not ex_pair:
         # ex_pair does not exist (currency not supported)
         raise ValueError('%s %s not supported' % (exchange, symbol))
@@ -61,10 +46,7 @@ def add_virgin_bals(cube, ex):
         # GDAX only includes tradeable currencies
         # Poloniex, Bitstamp returns all virgin currencies
         # Bitfinex, Kraken, Bittrex only return deflowered currencies
-        eps = ExPair.query.filter_by(
-            exchange=ex,
-            active=True
-        ).all()
+        eps = pair_index.active(ex.id)
         all_curs = {}
         for ep in eps:
             all_curs[ep.quote_currency] = None
@@ -1,25 +1,202 @@
-from optimizer import solve_allocations, calculate_transfers
+import json
+from hashlib import sha1
+import numpy as np
+from redis.exceptions import RedisError
+
+from optimizer import (SOLVER_BACKEND, UseRegression, solve, solve_many,
+                       verify_solution, calculate_transfers)
 from database import *
+# Replacing datetime.time (Do not move)
+from time import time
+from .store import get_redis
+
+WARM_START_TTL = int(os.getenv('WARM_START_TTL', 7 * 24 * 3600))
+SOLUTION_TTL = int(os.getenv('SOLUTION_TTL', 24 * 3600))
+SOLUTION_CACHE_SIZE = int(os.getenv('SOLUTION_CACHE_SIZE', 10000))
+SOLUTION_PRECISION = 4  # Decimals of each val as a fraction of the cube total
+SOLUTION_LRU_KEY = 'solutions:lru'
+
+
+def layout_digest(indiv):
+    # Identifies the (cur_id, ex_id) rows, in solver order
+    layout = [[int(cur_id), int(ex_id)] for cur_id, ex_id in indiv.index]
+    return sha1(json.dumps(layout).encode()).hexdigest()
+
+
+def load_start_vals(cube, layout):
+    """ Previous val_nnls of cube, or None if the layout has changed.
+    """
+    try:
+        raw = get_redis().get(f'warmstart:{cube.id}')
+    except RedisError as e:
+        log.warning(f'{cube} Warm start unavailable ({e})')
+        return None
+    if not raw:
+        return None
+    saved = json.loads(raw)
+    if saved['layout'] != layout:
+        log.debug(f'{cube} Balance layout changed (cold start)')
+        return None
+    return saved['vals']
+
+
+def save_start_vals(cube, layout, vals):
+    saved = {'layout': layout, 'vals': [float(v) for v in vals]}
+    try:
+        get_redis().set(f'warmstart:{cube.id}', json.dumps(saved), ex=WARM_START_TTL)
+    except RedisError as e:
+        log.warning(f'{cube} Unable to save warm start ({e})')
+
+
+def solver_settings(kwargs):
+    # solve() kwargs that can change the solution (start_vals only speeds it up)
+    return {
+        'use_regression': kwargs.get('use_regression', UseRegression.fallback).name,
+        'backend': kwargs.get('backend') or SOLVER_BACKEND,
+        'solver_params': kwargs.get('solver_params') or {},
+    }
+
+
+def fingerprint(indiv, comb, mode, **kwargs):
+    """ Hash of the allocation problem, independent of the cube's size.
+
+    Vals and targets are taken as fractions of the cube total, so the same
+    allocation template across cubes maps to the same solution. mode is the
+    problem solved ('L1' or 'L2') and kwargs the solver settings.
+    """
+    total = indiv.val.sum()
+    vals = indiv.val.sort_index() / total
+    tgts = comb.val_tgt.sort_index() / total
+    problem = {
+        'layout': [[int(cur_id), int(ex_id)] for cur_id, ex_id in vals.index],
+        'val': list(np.round(vals.values.astype(float), SOLUTION_PRECISION)),
+        'tgt': [[int(cur_id), round(float(t), SOLUTION_PRECISION)]
+                for cur_id, t in tgts.items()],
+        'mode': mode,
+        'solver': solver_settings(kwargs),
+    }
+    return sha1(json.dumps(problem, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def cached_solution(indiv, comb, **kwargs):
+    """ Previously solved allocation for an identical problem.
+
+    Returns (indiv, comb, mode) like optimizer.solve() with the same kwargs,
+    or (None, None, None) on a miss or if the scaled solution does not
+    satisfy this problem.
+    """
+    total = indiv.val.sum()
+    if not total > 0:
+        return None, None, None
+    # An L2 solution is only stored if L1 failed, so L1 is looked up first
+    keys = {mode: fingerprint(indiv, comb, mode, **kwargs) for mode in ['L1', 'L2']}
+    try:
+        r = get_redis()
+        found = [(mode, raw) for mode, raw in
+                 zip(keys, r.mget([f'solution:{key}' for key in keys.values()])) if raw]
+        if not found:
+            return None, None, None
+        mode, raw = found[0]
+        r.zadd(SOLUTION_LRU_KEY, {keys[mode]: time()})
+    except RedisError as e:
+        log.warning(f'Solution cache unavailable ({e})')
+        return None, None, None
+    saved = json.loads(raw)
+    indiv_sol, comb_sol = indiv.reset_index(), comb.copy()
+    fractions = pd.Series(saved['fractions'], index=indiv.index.sort_values())
+    indiv_sol['val_nnls'] = fractions.reindex(indiv.index).values * total
+    xc_funds = indiv.groupby(level='ex_id').val.sum().to_dict()
+    if not verify_solution(indiv_sol, comb.val_tgt.to_dict(), xc_funds,
+                           exchange_constraints=mode == 'L1'):
+        return None, None, None
+    return indiv_sol, comb_sol, mode
+
+
+def store_solution(indiv, comb, indiv_sol, mode, **kwargs):
+    total = indiv.val.sum()
+    if not total > 0:
+        return
+    key = fingerprint(indiv, comb, mode, **kwargs)
+    # Solver rows are in the order of indiv; store them in index order
+    val_nnls = pd.Series(indiv_sol.val_nnls.values.astype(float), index=indiv.index)
+    saved = {'fractions': list(val_nnls.sort_index().values / total)}
+    try:
+        r = get_redis()
+        pipe = r.pipeline()
+        pipe.set(f'solution:{key}', json.dumps(saved), ex=SOLUTION_TTL)
+        pipe.zadd(SOLUTION_LRU_KEY, {key: time()})
+        # Drop entries that expired or were least recently used
+        pipe.zremrangebyscore(SOLUTION_LRU_KEY, 0, time() - SOLUTION_TTL)
+        pipe.zcard(SOLUTION_LRU_KEY)
+        size = pipe.execute()[-1]
+        if size > SOLUTION_CACHE_SIZE:
+            evict = r.zrange(SOLUTION_LRU_KEY, 0, size - SOLUTION_CACHE_SIZE - 1)
+            pipe = r.pipeline()
+            pipe.delete(*[b'solution:' + k for k in evict])
+            pipe.zrem(SOLUTION_LRU_KEY, *evict)
+            pipe.execute()
+    except RedisError as e:
+        log.warning(f'Unable to cache solution ({e})')
 
 
 def regression(cube: Cube, indiv, comb, **kwargs):
     # Perform non-negative linear regression to determine individual vals
     # Set individual balance targets in db
 
-    indiv_sol, comb_sol = solve_allocations(indiv, comb, cube.val_cur.id, **kwargs)
-    if indiv_sol is not None:
-        log.info("Found L1 solution.")
-        cube.requires_exchange_transfer = False
-        indiv, comb = indiv_sol, comb_sol
+    layout = layout_digest(indiv)
+    indiv_sol, comb_sol, mode = cached_solution(indiv, comb, **kwargs)
+    if mode:
+        log.debug(f'{cube} Using cached solution')
     else:
-        # Try to solve without exchange constraints
-        cube.requires_exchange_transfer = True
-        indiv, comb = solve_allocations(indiv, comb, cube.val_cur.id, L1=False, **kwargs)
-        if indiv is not None:
-            log.info("Found L2 solution.")
-        else:
-            log.info("No solution.")
-            return None, None
+        # Warm start from the previous solution if the balances are the same
+        kwargs.setdefault('start_vals', load_start_vals(cube, layout))
+        indiv_sol, comb_sol, mode = solve(indiv, comb, cube.val_cur.id, **kwargs)
+        if mode:
+            store_solution(indiv, comb, indiv_sol, mode, **kwargs)
+    return apply_solution(cube, layout, indiv_sol, comb_sol, mode)
+
+
+def regression_batch(problems, **kwargs):
+    """ regression() for many cubes, solving in a process pool.
+
+    problems maps cube -> (indiv, comb). Targets are set one cube at a time
+    once everything is solved. Returns cube.id -> solve_many() result.
+    """
+    layouts, solves, results = {}, {}, {}
+    for cube, (indiv, comb) in problems.items():
+        layouts[cube.id] = layout_digest(indiv)
+        indiv_sol, comb_sol, mode = cached_solution(indiv, comb, **kwargs)
+        if mode:
+            results[cube.id] = {'indiv': indiv_sol, 'comb': comb_sol,
+                                'status': mode, 'time': 0}
+            continue
+        start_vals = load_start_vals(cube, layouts[cube.id])
+        solves[cube.id] = (indiv, comb, cube.val_cur.id, {'start_vals': start_vals})
+    results.update(solve_many(solves, **kwargs))
+    for cube, (indiv, comb) in problems.items():
+        r = results[cube.id]
+        if cube.id in solves and r['status'] in ['L1', 'L2']:
+            store_solution(indiv, comb, r['indiv'], r['status'], **kwargs)
+        mode = r['status'] if r['status'] in ['L1', 'L2'] else None
+        try:
+            r['indiv'], r['comb'] = apply_solution(
+                cube, layouts[cube.id], r['indiv'], r['comb'], mode)
+        except Exception:
+            log.exception(f'{cube} Unable to set balance targets')
+            db_session.rollback()
+            r['status'] = 'error'
+    return results
+
+
+def apply_solution(cube, layout, indiv, comb, mode):
+    # Exchange transfers are needed unless the L1 problem was solved
+    cube.requires_exchange_transfer = mode != 'L1'
+    if mode is None:
+        log.info("No solution.")
+        return None, None
+    log.info(f"Found {mode} solution.")
+
+    save_start_vals(cube, layout, indiv.val_nnls)
 
     # Use indiv prices 
     indiv['bal_tgt'] = indiv.val_nnls / indiv.price
@@ -40,19 +217,13 @@ def regression(cube: Cube, indiv, comb, **kwargs):
 
     set_target_balances(cube, indiv)
 
-    ## Legacy: transfer details not needed in current version of Coincube
-    # if cube.requires_exchange_transfer:
-    #     buy_amounts, transfers, sell_amounts = calculate_transfers(indiv)
-    #     transfer_details = {
-    #         'buy_amounts': buy_amounts,
-    #         'transfers': transfers,
-    #         'sell_amounts': sell_amounts,
-    #     }
-    # else:
-    #     transfer_details = {}
-    print(indiv)
-    print(comb)
-    print('end regression')
+    if cube.requires_exchange_transfer and indiv.index.get_level_values('ex_id').nunique() > 1:
+        try:
+            sell_amounts, transfers, buy_amounts = calculate_transfers(indiv)
+            log.info('%s Exchange transfers required\n%s' % (cube, transfers))
+        except Exception:
+            log.exception(f'{cube} Unable to plan exchange transfers')
+    log.debug('%s Balance targets\n%s' % (cube, indiv.loc[:, ['val_nnls', 'bal_tgt']]))
     return indiv, comb
 
 
@@ -0,0 +1,111 @@
+""" Celery queues per exchange, so one slow exchange only holds its own workers.
+
+    python -m utils.routing    # print one worker command per queue
+"""
+from math import ceil
+
+from database import *
+from .limiter import get_limit
+
+log = logging.getLogger(__name__)
+
+OPTIMIZER_QUEUE = os.getenv('OPTIMIZER_QUEUE', 'optimizer')
+MULTI_QUEUE = 'ex.multi'  # Cubes connected to several exchanges
+REQUEST_TIME = float(os.getenv('WORKER_REQUEST_TIME', 0.5))  # Seconds per EXAPI request
+MAX_CONCURRENCY = int(os.getenv('WORKER_MAX_CONCURRENCY', 16))
+MAX_PREFETCH = 4
+
+# Tasks whose first argument is a cube_id
+CUBE_TASKS = ['process_cube', 'reconcile_cube', 'new_orders', 'place_orders',
+              'cancel_orders', 'trigger_rebalance']
+# CPU bound, no EXAPI requests
+OPTIMIZER_TASKS = ['optimize_cubes']
+# Tasks whose first argument is an exchange id
+EXCHANGE_TASKS = ['process_exchange_batch']
+
+
+def exchange_queue(name):
+    return f"ex.{name.lower().replace(' ', '_')}"
+
+
+def cube_queue(cube):
+    names = {conn.exchange.name for conn in cube.connections.values()}
+    if not names and cube.exchange:
+        names = {cube.exchange.name}
+    if len(names) == 1:
+        return exchange_queue(names.pop())
+    return MULTI_QUEUE
+
+
+def cube_id_queue(cube_id):
+    names = {name for name, in db_session.query(Exchange.name).join(
+        Connection, Connection.exchange_id == Exchange.id).filter(
+        Connection.cube_id == cube_id)}
+    if len(names) == 1:
+        return exchange_queue(names.pop())
+    if not names:
+        cube = Cube.query.get(cube_id)
+        if cube and cube.exchange:
+            return exchange_queue(cube.exchange.name)
+    return MULTI_QUEUE
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """ Celery router: cube tasks go to their exchange's queue.
+
+    A queue passed explicitly (e.g. by run_trader) is kept as is.
+    """
+    if options.get('queue'):
+        return None
+    name = name.rsplit('.', 1)[-1]
+    if name in OPTIMIZER_TASKS:
+        return {'queue': OPTIMIZER_QUEUE}
+    if name in CUBE_TASKS:
+        cube_id = args[0] if args else kwargs.get('cube_id')
+        if cube_id is not None:
+            return {'queue': cube_id_queue(cube_id)}
+    if name in EXCHANGE_TASKS:
+        ex = Exchange.query.get(args[0] if args else kwargs.get('ex_id'))
+        if ex:
+            return {'queue': exchange_queue(ex.name)}
+    return None
+
+
+def worker_settings(exchange=None):
+    """ Concurrency and prefetch for an exchange queue.
+
+    Private budgets are per API key, so cubes don't compete for them; the
+    budget every task on the queue shares is the exchange's public one.
+    Enough worker slots to keep that busy (slots beyond it would only wait
+    on the rate limiter), and prefetch only as much as its burst allowance
+    can start at once.
+    """
+    limit = get_limit(exchange, 'public')
+    concurrency = max(1, min(MAX_CONCURRENCY, ceil(limit['rate'] * REQUEST_TIME)))
+    prefetch = max(1, min(MAX_PREFETCH, limit['burst'] // concurrency))
+    return {'concurrency': concurrency, 'prefetch': prefetch}
+
+
+def worker_command(app, queue, concurrency, prefetch):
+    return (f'celery -A {app} worker -Q {queue} -n {queue}@%h '
+            f'-c {concurrency} --prefetch-multiplier {prefetch}')
+
+
+def worker_commands(exchanges=None):
+    if exchanges is None:
+        exchanges = [ex.name for ex in Exchange.query.all()]
+    # Solo pool: the worker isn't a daemonic child, so solve_many can spread
+    # each batch over a process pool (SOLVE_WORKERS, all cores by default)
+    commands = [f'celery -A trader worker -Q {OPTIMIZER_QUEUE} -n {OPTIMIZER_QUEUE}@%h '
+                f'-P solo --prefetch-multiplier 1']
+    for name in exchanges:
+        commands.append(worker_command('trader', exchange_queue(name),
+                                       **worker_settings(name)))
+    # Cubes on several exchanges are held to the default budget
+    commands.append(worker_command('trader', MULTI_QUEUE, **worker_settings()))
+    commands.append('celery -A celery_update worker -B -Q celery -n celery@%h -c 1')
+    return commands
+
+
+if __name__ == '__main__':
+    print('\n'.join(worker_commands()))
@@ -0,0 +1,114 @@
+from redis.exceptions import RedisError
+
+from database import *
+from .store import get_redis
+from .lease import LEASE_TTL, leased
+
+SCHEDULE_KEY = 'trader:due'  # Sorted set of cube_id scored by due time
+SYNCED_KEY = 'trader:synced_at'
+SUSPEND = timedelta(minutes=10)
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_score(dt):
+    return (dt - EPOCH).total_seconds()
+
+
+def active_filter():
+    return and_(
+        Cube.closed_at == None,
+        Cube.trading_status == 'live',
+        Cube.algorithm.has(Algorithm.name.in_(['Centaur'])),
+        not_(Cube.connections.any(Connection.failed_at != None)),
+        Cube.connections.any()
+        )
+
+
+def next_due(cube, processing=False, has_orders=False, now=None):
+    """ When cube should next be processed (same rules as the old full scan).
+    """
+    now = now or datetime.utcnow()
+    if processing:
+        # The running chain reschedules on completion, or the lease expires
+        return now + timedelta(seconds=LEASE_TTL)
+    if not cube.balanced_at:
+        return now
+    if cube.reallocated_at and cube.reallocated_at >= cube.balanced_at:
+        return now
+    if has_orders:
+        return now
+    if cube.suspended_at and cube.suspended_at + SUSPEND > now:
+        return cube.suspended_at + SUSPEND
+    return now
+
+
+def due_times(cubes, now=None):
+    """ cube.id -> next due time, using one query for open orders.
+    """
+    now = now or datetime.utcnow()
+    ids = [cube.id for cube in cubes]
+    if not ids:
+        return {}
+    processing = leased(ids)
+    ordering = {cube_id for cube_id, in db_session.query(Order.cube_id).filter(
+        Order.cube_id.in_(ids)).distinct()}
+    return {cube.id: next_due(cube, cube.id in processing, cube.id in ordering, now)
+            for cube in cubes}
+
+
+def schedule(due):
+    """ Set due times (cube_id -> datetime). """
+    if not due:
+        return
+    try:
+        get_redis().zadd(SCHEDULE_KEY, {cube_id: to_score(dt) for cube_id, dt in due.items()})
+    except RedisError as e:
+        log.warning(f'Unable to schedule cubes ({e})')
+
+
+def schedule_cube(cube):
+    schedule(due_times([cube]))
+
+
+def rebuild_schedule():
+    """ Recompute every active cube's due time (startup and drift repair). """
+    now = datetime.utcnow()
+    due = due_times(Cube.query.filter(active_filter()).all(), now)
+    r = get_redis()
+    pipe = r.pipeline()
+    pipe.delete(SCHEDULE_KEY)
+    if due:
+        pipe.zadd(SCHEDULE_KEY, {cube_id: to_score(dt) for cube_id, dt in due.items()})
+    pipe.set(SYNCED_KEY, to_score(now))
+    pipe.execute()
+    log.info(f'Scheduled {len(due)} cubes')
+
+
+def sync_schedule():
+    """ Pick up cubes created, reallocated or toggled since the last sync.
+
+    Cost is proportional to the number of changed cubes. Falls back to a
+    full rebuild if the schedule has never been built.
+    """
+    r = get_redis()
+    synced = r.get(SYNCED_KEY)
+    if synced is None:
+        return rebuild_schedule()
+    now = datetime.utcnow()
+    since = EPOCH + timedelta(seconds=float(synced))
+    changed = or_(Cube.updated_at >= since, Cube.reallocated_at >= since)
+    schedule(due_times(Cube.query.filter(changed, active_filter()).all(), now))
+    inactive = [cube_id for cube_id, in db_session.query(Cube.id).filter(
+        changed, not_(active_filter()))]
+    if inactive:
+        r.zrem(SCHEDULE_KEY, *inactive)
+    r.set(SYNCED_KEY, to_score(now))
+
+
+def pop_due(now=None):
+    """ Remove and return the ids of all due cubes, earliest first. """
+    score = to_score(now or datetime.utcnow())
+    pipe = get_redis().pipeline()
+    pipe.zrangebyscore(SCHEDULE_KEY, 0, score)
+    pipe.zremrangebyscore(SCHEDULE_KEY, 0, score)
+    return [int(cube_id) for cube_id in pipe.execute()[0]]
@@ -0,0 +1,15 @@
+import redis
+
+from database import *
+
+REDIS_URI = os.getenv('REDIS_URI', os.getenv('CELERY_BROKER_URL'))
+
+_redis = None
+
+
+def get_redis():
+    # Shared by every worker process (rate limits, caches, locks)
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(REDIS_URI)
+    return _redis